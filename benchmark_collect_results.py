@@ -0,0 +1,49 @@
+'''Benchmark collect_results.all_csvs on synthetic CERES results.
+Run e.g. python benchmark_collect_results.py 10000'''
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import collect_results
+
+
+def make_results(direct, nresults=10000, seed=0):
+    '''Write nresults synthetic <night>_red/proc/results.txt files (and
+    achievable_rvs.txt) to direct'''
+    rng = np.random.default_rng(seed)
+    for ii in range(nresults):
+        procdir = os.path.join(direct, '{:08d}_red'.format(ii), 'proc')
+        os.makedirs(procdir)
+        bjd = 2453000. + ii + rng.random()
+        with open(os.path.join(procdir, 'results.txt'), 'w') as fres:
+            fres.write('HD_{} {:.6f} {:.6f} {:.6f} {:.6f} {:.6f} FEROS ceres 48000 \
+5750 4.4 0.0 2.0 0.8 0.05 900 {:.1f} {}\n'.format(
+                ii % 50, bjd, rng.normal(), rng.random() * 0.01, rng.normal() * 0.01,
+                rng.random() * 0.01, rng.random() * 100 + 50,
+                os.path.join(procdir, 'HD_{}_{}.pdf'.format(ii % 50, ii))))
+        with open(os.path.join(os.path.dirname(procdir), 'achievable_rvs.txt'),
+                  'w') as frv:
+            frv.write('{:.2f}\n'.format(rng.random() * 10))
+
+
+def run(nresults=10000, nworkers=8):
+    with tempfile.TemporaryDirectory() as direct:
+        tstart = time.time()
+        make_results(direct, nresults)
+        print('Wrote {} results.txt in {:.1f}s'.format(nresults,
+                                                       time.time() - tstart))
+        tstart = time.time()
+        t_obs = collect_results.all_csvs(science_dir=direct, log_dir=direct,
+                                         nworkers=nworkers)
+        dtime = time.time() - tstart
+    print('Collected {} observations in {:.1f}s ({:.0f} files/s)'.format(
+        len(t_obs), dtime, nresults / dtime))
+    return dtime
+
+
+if __name__ == '__main__':
+    nresults = 10000
+    if len(sys.argv) > 1:
+        nresults = int(sys.argv[1])
+    run(nresults)
@@ -1,48 +1,140 @@
 import os
 import numpy as np
 import pandas as pd
-import subprocess
 import matplotlib.pyplot as plt
 import seaborn as sns
-from astropy.table import Table, vstack
+from astropy.table import Table
 from astropy.time import Time
 from glob import glob
 import io
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    as_completed
 from config import default_science_dir, default_log_dir
 
 nceres = 18  # number of ceres outputs
 achievable_rv_lim = 7.  # max output number of rv_lim to still consider it good. Paula said ~2-3
+# columns of the observation summary. The last nceres are the ones from CERES
+tentries = ['achievable_rvs_good', 
+            'target','bjd','rv','sig_rv','bisec_span','sig_bisec_span',#from ceres output
+            'inst','pipeline','resolving_power',
+            'Teff','logg','[Fe/H]','vsini',
+            'lowest_continuum','std_gaus2ccf',
+            'Texp','snr','pdfpath',]
+dtypes  =  [bool,
+            str,np.float64,np.float64,np.float64,np.float64,np.float64,
+            str,str,np.float64,
+            np.float64,np.float64,np.float64,np.float64,
+            np.float64,np.float64,
+            np.float64,np.float64,str,]
 
 
-def get_pdfs():
+def get_pdfs(science_dir=None, nworkers=4, chunksize=200, force=False):
     '''get the PDFS for all stars and store it in the parent directory for
-    each star individually'''
-    dirs = [os.path.join(par_dir, o) for o in os.listdir(par_dir) 
-            if os.path.isdir(os.path.join(par_dir,o))]
-    for ddir in dirs:
-        dtarget = os.path.basename(ddir)
-
-        pnpdfs = []
-        pndates = [os.path.join(ddir, o) for o in os.listdir(ddir)
-                   if (os.path.isdir(os.path.join(ddir,o)) and o.endswith('_red'))]
-        for pndate in pndates:
-            pdfdir = os.path.join(pndate, 'proc')
-            pnpdfs += [os.path.join(pdfdir, ff) for ff in os.listdir(pdfdir)
-                           if ff.endswith('.pdf')]
-
-        if len(pnpdfs) >= 1:
-            print('Found and merging {} pdfs for {}'.format(len(pnpdfs), dtarget))
-            subprocess.run(["pdftk",]+pnpdfs+ ["output",
-                            os.path.join(ddir, "allpdfs_{}.pdf".format(dtarget))])
+    each star individually. The targets are merged in parallel by nworkers
+    processes. If the allpdfs_<target>.pdf exists, only the pdfs which are not
+    in it yet (see allpdfs_<target>.txt) are appended.
+    chunksize=200
+    number of pdfs opened at the same time
+    force=False
+    set to True to merge all pdfs again'''
+    if science_dir is None:
+        science_dir = default_science_dir
+    dirs = [os.path.join(science_dir, o) for o in os.listdir(science_dir)
+            if os.path.isdir(os.path.join(science_dir,o))]
+    with ProcessPoolExecutor(max_workers=nworkers) as pool:
+        futures = [pool.submit(_merge_target_pdfs, ddir, chunksize=chunksize,
+                               force=force) for ddir in dirs]
+        for future in as_completed(futures):
+            future.result()
+
+
+def _merge_target_pdfs(ddir, chunksize=200, force=False):
+    '''Merge the pdfs of the reduced nights of a target directory'''
+    dtarget = os.path.basename(ddir)
+    pnout = os.path.join(ddir, "allpdfs_{}.pdf".format(dtarget))
+    pnmerged = os.path.join(ddir, "allpdfs_{}.txt".format(dtarget))
+
+    pnpdfs = []
+    pndates = [os.path.join(ddir, o) for o in os.listdir(ddir)
+               if (os.path.isdir(os.path.join(ddir,o)) and o.endswith('_red'))]
+    for pndate in sorted(pndates):
+        pdfdir = os.path.join(pndate, 'proc')
+        if os.path.isdir(pdfdir):
+            pnpdfs += sorted([os.path.join(pdfdir, ff) for ff in os.listdir(pdfdir)
+                              if ff.endswith('.pdf')])
+    if len(pnpdfs) == 0:
+        print('No pdf found for {}'.format(dtarget))
+        return
+    entries = ['{} {} {}'.format(pn, os.stat(pn).st_mtime, os.stat(pn).st_size)
+               for pn in pnpdfs]
+
+    merged = []
+    if not force and os.path.exists(pnout) and os.path.exists(pnmerged):
+        with open(pnmerged, 'r') as fmerged:
+            merged = fmerged.read().splitlines()
+    if not set(merged).issubset(entries):
+        # some merged pdfs were removed or reduced again
+        merged = []
+    new = [pn for pn, entry in zip(pnpdfs, entries) if entry not in merged]
+    if len(new) == 0:
+        print('All {} pdfs of {} are merged already'.format(len(pnpdfs),
+                                                             dtarget))
+        return
+    print('Found and merging {} new pdfs for {}'.format(len(new), dtarget))
+
+    # merge in chunks, so not all files are open at the same time
+    parts = []
+    if len(merged) > 0:
+        parts.append(pnout)
+    for ii in range(0, len(new), chunksize):
+        pnpart = pnout + '.part{}'.format(ii // chunksize)
+        _merge_pdfs(new[ii:ii+chunksize], pnpart)
+        parts.append(pnpart)
+    if len(parts) == 1:
+        os.replace(parts[0], pnout+'.tmp')
+    else:
+        _merge_pdfs(parts, pnout+'.tmp')
+    os.replace(pnout+'.tmp', pnout)
+    with open(pnmerged+'.tmp', 'w') as fmerged:
+        fmerged.write('\n'.join(merged + [entry for entry in entries
+                                         if entry not in merged]) + '\n')
+    os.replace(pnmerged+'.tmp', pnmerged)
+    for pnpart in parts:
+        if pnpart != pnout and os.path.exists(pnpart):
+            os.remove(pnpart)
 
-        else:
-            print('No pdf found for {}'.format(dtarget))
 
+def _merge_pdfs(pnpdfs, pnout):
+    from PyPDF2 import PdfFileMerger
+    merger = PdfFileMerger(strict=False)
+    try:
+        for pn in pnpdfs:
+            merger.append(pn)
+        with open(pnout, 'wb') as fout:
+            merger.write(fout)
+    finally:
+        merger.close()
 
-def all_csvs(science_dir=None, log_dir=None, activity_indicators=False):
+
+def all_csvs(science_dir=None, log_dir=None, activity_indicators=False,
+             nworkers=8, extra_format=None, update=False, store=False):
     '''Collects all the data from the FEROS reanalysis and store in a single table
     activity_indicators=False
-    If True, it will try to determine activity_indicators such as H_alpha and others'''
+    If True, it will try to determine activity_indicators such as H_alpha and others
+    (see add_activity_indicators)
+    nworkers=8
+    number of threads reading the results.txt files
+    extra_format=None
+    'parquet' or 'hdf5' to store a copy of the table in this format
+    update=False
+    If True, only read the proc directories whose results changed since the
+    last run (stored in observation_summary_index.json in the log_dir) and
+    update observation_summary.csv. Rows of removed directories are dropped.
+    store=False
+    If True, also write the table to the parquet results store (see
+    write_results_store and load_rvs)'''
     if science_dir is None:
         science_dir = default_science_dir
     if log_dir is None:
@@ -50,109 +142,359 @@ def all_csvs(science_dir=None, log_dir=None, activity_indicators=False):
     for direct in [log_dir]:
         if not os.path.exists(direct):
             os.mkdir(direct)
-    
-    tentries = ['achievable_rvs_good', 
-                'target','bjd','rv','sig_rv','bisec_span','sig_bisec_span',#from ceres output
-                'inst','pipeline','resolving_power',
-                'Teff','logg','[Fe/H]','vsini',
-                'lowest_continuum','std_gaus2ccf',
-                'Texp','snr','pdfpath',]
-    dtypes  =  [bool,
-                str,np.float64,np.float64,np.float64,np.float64,np.float64,
-                str,str,np.float64,
-                np.float64,np.float64,np.float64,np.float64,
-                np.float64,np.float64,
-                np.float64,np.float64,str,]
-    t_obs = Table([[]]*len(tentries),names=tentries,dtype=dtypes)
-
-    procdirectories = glob('**/~proc/', recursive=True)
-    for procdir in procdirectories:
-        fnresults = os.path.join(procdir, 'results.txt')
-        par_dir = os.path.abspath(os.path.normpath(os.path.join(
-            procdir, os.pardir)))
-        fnachievable_rvs = os.path.join(par_dir, 'achievable_rvs.txt')
-        try:
-            tdum = Table.read(fnresults,
-                              delimiter=" ",names=tentries[-nceres:],
-                              format='ascii.no_header', guess =False)
-        except IOError:
-            print('Coudnt find {}'.format(fnresults))
-            continue
-        except (IOError, ValueError) as error:
-            print('The observation of %s at day %s were not analysed'%(target,night),\
-                  'Probably no calibration files were found')
-        tdum['achievable_rvs_good'] = False
+    pntable = os.path.join(log_dir, 'observation_summary.csv',)
+    pnindex = os.path.join(log_dir, 'observation_summary_index.json')
+
+    procdirectories = glob(os.path.join(science_dir, '**/proc/'), recursive=True)
+    fingerprints = {os.path.abspath(os.path.join(procdir, 'results.txt')):
+                    _results_fingerprint(procdir) for procdir in procdirectories}
+    t_old = None
+    if update and os.path.exists(pntable) and os.path.exists(pnindex):
+        with open(pnindex, 'r') as findex:
+            old_fingerprints = json.load(findex)
+        t_old = pd.read_csv(pntable, sep=',')
+        if 'resultspath' not in t_old.columns:
+            t_old = None
+    if t_old is not None:
+        procdirectories = [procdir for procdir in procdirectories if
+                           old_fingerprints.get(os.path.abspath(os.path.join(
+                               procdir, 'results.txt'))) !=
+                           fingerprints[os.path.abspath(os.path.join(
+                               procdir, 'results.txt'))]]
+        nremoved = len([pn for pn in old_fingerprints.keys()
+                        if pn not in fingerprints])
+        # keep the unchanged ones
+        t_old = t_old[[(pn in fingerprints) and
+                       (old_fingerprints.get(pn) == fingerprints[pn])
+                       for pn in t_old['resultspath']]]
+        print('Updating {} changed proc directories, removing {}'.format(
+            len(procdirectories), nremoved))
+    else:
+        print('Collecting the results of {} proc directories'.format(
+            len(procdirectories)))
+    with ThreadPoolExecutor(max_workers=nworkers) as pool:
+        tables = list(pool.map(_read_procdir, procdirectories))
+    if t_old is not None:
+        tables = [t_old, ] + tables
+    t_obs = _concat_results([tdum for tdum in tables if tdum is not None])
+    if activity_indicators:
+        t_obs = add_activity_indicators(t_obs, log_dir=log_dir)
+
+    t_obs.to_csv(pntable, sep=',', index=False)
+    with open(pnindex, 'w') as findex:
+        json.dump(fingerprints, findex, indent=1)
+    if extra_format == 'parquet':
+        t_obs.to_parquet(pntable[:-4]+'.parquet', index=False)
+    elif extra_format == 'hdf5':
+        t_obs.to_hdf(pntable[:-4]+'.h5', key='observations', mode='w')
+    if store:
+        write_results_store(t_obs, store_dir=os.path.join(log_dir,
+                                                          'results_store'))
+    print('Done with collect_rv_data.collect. Saved table in {}'.format(pntable))
+    return t_obs
+
+
+def write_results_store(t_obs, store_dir=None, by_year=True):
+    '''Store the observation table from all_csvs as parquet files partitioned
+    by target (and year of the bjd), e.g.
+    store_dir/target=HD_10700/year=2012/part.parquet
+    Partitions not in t_obs anymore are removed. Use load_rvs to read them.
+    Observations without bjd are stored in year=unknown.
+    store_dir=None
+    Uses results_store in the default_log_dir if None'''
+    if store_dir is None:
+        store_dir = os.path.join(default_log_dir, 'results_store')
+    t_obs = t_obs.copy()
+    if by_year:
+        years = _bjd2year(t_obs['bjd'])
+        t_obs['year'] = [str(int(year)) if np.isfinite(year) else 'unknown'
+                         for year in years]
+        nunknown = np.sum(~np.isfinite(years))
+        if nunknown > 0:
+            print('{} observations have no bjd. Storing them in year=unknown'.format(
+                nunknown))
+    else:
+        t_obs['year'] = -1
+    written = []
+    for (target, year), group in t_obs.groupby(['target', 'year'], dropna=False):
+        pndir = os.path.join(store_dir, 'target={}'.format(
+            str(target).replace(os.sep, '_')))
+        if by_year:
+            pndir = os.path.join(pndir, 'year={}'.format(year))
+        if not os.path.exists(pndir):
+            os.makedirs(pndir)
+        pnpart = os.path.join(pndir, 'part.parquet')
+        group.drop(columns='year').to_parquet(pnpart+'.tmp', index=False)
+        os.replace(pnpart+'.tmp', pnpart)
+        written.append(os.path.abspath(pnpart))
+    for pnpart in glob(os.path.join(store_dir, '**/part.parquet'), recursive=True):
+        if os.path.abspath(pnpart) not in written:
+            os.remove(pnpart)
+    print('Stored {} partitions in {}'.format(len(written), store_dir))
+
+
+def load_rvs(target, bjd_min=None, bjd_max=None, good_only=True,
+             columns=['target', 'bjd', 'rv', 'sig_rv', 'achievable_rvs_good'],
+             store_dir=None):
+    '''Read the observations of target from the results store written by
+    write_results_store. Only the partitions of the years between bjd_min and
+    bjd_max and the given columns are read.
+    good_only=True
+    only return observations with achievable_rvs_good
+    columns
+    the columns to return. None returns all'''
+    if store_dir is None:
+        store_dir = os.path.join(default_log_dir, 'results_store')
+    pnparts = glob(os.path.join(store_dir, 'target={}'.format(
+        str(target).replace(os.sep, '_')), '**/part.parquet'), recursive=True)
+    year_min = _bjd2year([bjd_min])[0] if bjd_min is not None else -np.inf
+    year_max = _bjd2year([bjd_max])[0] if bjd_max is not None else np.inf
+    if columns is not None:
+        readcolumns = list(dict.fromkeys(list(columns) +
+                                         ['bjd', 'achievable_rvs_good']))
+    else:
+        readcolumns = None
+    tables = []
+    for pnpart in pnparts:
+        pndir = os.path.basename(os.path.dirname(pnpart))
+        if pndir == 'year=unknown':
+            # no bjd, so they cant be in a bjd range
+            if bjd_min is not None or bjd_max is not None:
+                continue
+        elif pndir.startswith('year='):
+            year = int(pndir[5:])
+            if year < year_min or year > year_max:
+                continue
+        tables.append(pd.read_parquet(pnpart, columns=readcolumns))
+    if len(tables) == 0:
+        return pd.DataFrame(columns=columns)
+    t_rvs = pd.concat(tables, ignore_index=True)
+    mask = np.ones(len(t_rvs), dtype=bool)
+    if bjd_min is not None:
+        mask &= t_rvs['bjd'] >= bjd_min
+    if bjd_max is not None:
+        mask &= t_rvs['bjd'] <= bjd_max
+    if good_only:
+        mask &= t_rvs['achievable_rvs_good'].astype(bool)
+    t_rvs = t_rvs[mask].sort_values('bjd').reset_index(drop=True)
+    if columns is not None:
+        t_rvs = t_rvs[list(columns)]
+    return t_rvs
+
+
+def add_activity_indicators(t_obs, log_dir=None, nworkers=None):
+    '''Determine the activity indicators (H_alpha and others) from the CERES
+    _sp.fits spectra of the observations and add them as columns to t_obs
+    (joined by target and bjd). The spectra are analysed by nworkers processes.
+    The indicators are stored in activity_cache.sqlite in the log_dir by path,
+    size and mtime of the spectrum, so only new or changed spectra are
+    analysed again.'''
+    if log_dir is None:
+        log_dir = default_log_dir
+    pnspectra = _find_spectra(t_obs)
+    print('Found spectra of {} of {} observations'.format(len(pnspectra),
+                                                          len(t_obs)))
+    con = sqlite3.connect(os.path.join(log_dir, 'activity_cache.sqlite'),
+                          timeout=60)
+    con.execute('CREATE TABLE IF NOT EXISTS indicators (path TEXT PRIMARY KEY, \
+size INTEGER, mtime REAL, indicators TEXT)')
+    cached = dict([(row[0], row[1:]) for row in con.execute(
+        'SELECT path, size, mtime, indicators FROM indicators')])
+    indicators = {}
+    todo = []
+    spectrum2target = dict([(pn, target) for (target, bjd), pn in
+                            pnspectra.items()])
+    for pnspectrum, target in spectrum2target.items():
+        stat = os.stat(pnspectrum)
+        if cached.get(pnspectrum, [None, None])[:2] == (stat.st_size,
+                                                        stat.st_mtime):
+            indicators[pnspectrum] = json.loads(cached[pnspectrum][2])
+        else:
+            todo.append((pnspectrum, stat.st_size, stat.st_mtime))
+    print('Determining the activity indicators of {} spectra ({} known \
+already)'.format(len(todo), len(indicators)))
+    with ProcessPoolExecutor(max_workers=nworkers) as pool:
+        todo_indicators = list(pool.map(
+            _activity_indicators, [pn for pn, size, mtime in todo],
+            [spectrum2target[pn] for pn, size, mtime in todo], chunksize=10))
+    with con:
+        con.executemany('INSERT OR REPLACE INTO indicators VALUES (?, ?, ?, ?)',
+                        [(pn, size, mtime, json.dumps(indics)) for
+                         (pn, size, mtime), indics in zip(todo, todo_indicators)
+                         if indics is not None])
+    con.close()
+    for (pn, size, mtime), indics in zip(todo, todo_indicators):
+        if indics is not None:
+            indicators[pn] = indics
+
+    t_act = pd.DataFrame([dict([('target', target), ('bjd', bjd)] +
+                               list(indicators[pn].items()))
+                          for (target, bjd), pn in pnspectra.items()
+                          if pn in indicators])
+    if len(t_act) == 0:
+        return t_obs
+    # replace the indicators of an older run
+    t_obs = t_obs.drop(columns=[col for col in t_act.columns if col in
+                                t_obs.columns and col not in ['target', 'bjd']])
+    return t_obs.merge(t_act, on=['target', 'bjd'], how='left')
+
+
+def _find_spectra(t_obs):
+    '''The _sp.fits spectrum of each observation as dict of (target, bjd) and
+    the path. Each proc directory is listed only once'''
+    pnspectra = {}
+    spectra = {}
+    isots = Time(np.asarray(t_obs['bjd'], dtype=float), format='jd').isot \
+        if len(t_obs) > 0 else []
+    for target, bjd, pnresults, isot in zip(t_obs['target'], t_obs['bjd'],
+                                            t_obs['resultspath'], isots):
+        procdir = os.path.dirname(pnresults)
+        if procdir not in spectra:
+            try:
+                spectra[procdir] = [ff for ff in os.listdir(procdir)
+                                    if ff.endswith('_sp.fits')]
+            except OSError:
+                spectra[procdir] = []
+        for ff in spectra[procdir]:
+            if ff.endswith(isot + '_sp.fits'):
+                pnspectra[(target, bjd)] = os.path.join(procdir, ff)
+                break
+    return pnspectra
+
+
+def _activity_indicators(pnspectrum, target):
+    '''The activity indicators of a CERES spectrum as dict of the indicator
+    and its error (with the suffix err). None if they couldnt be determined'''
+    try:
+        from starclass import Star
+        star = Star(target)
+        star.read_ceres_spectrum(pnspectrum)
+        star.get_activity_indicators()
+        actindics = star.activity_indicators()
+        if isinstance(actindics, dict):
+            actindics = actindics.items()
+        indicators = {}
+        for aidx, valerr in actindics:
+            indicators[aidx] = float(valerr[0])
+            indicators[aidx+'err'] = float(valerr[1])
+        return indicators
+    except IOError:
+        print('Couldnt get activity indicators since file {} not \
+found'.format(pnspectrum))
+    except Exception as error:
+        print('Couldnt get activity indicators of {} ({})'.format(pnspectrum,
+                                                                 error))
+    return None
+
+
+def _bjd2year(bjds):
+    '''The calendar year of (barycentric) julian dates. nan for nan dates'''
+    return np.asarray(pd.to_datetime(np.asarray(bjds, dtype=float) - 2440587.5,
+                                     unit='D').year, dtype=float)
+
+
+def _results_fingerprint(procdir):
+    '''mtime and size of the results.txt and achievable_rvs.txt of procdir.
+    None for files that dont exist.'''
+    fingerprint = []
+    for pn in [os.path.join(procdir, 'results.txt'),
+               os.path.join(procdir, os.pardir, 'achievable_rvs.txt')]:
         try:
-            with open(fnachievable_rvs, "r") as frv:
-                rvs = frv.read().strip().split('\n')
-            if rvs[0] == "":
-                rvs = [np.nan]
-            rvs = np.array([float(rv) for rv in rvs])
-            if np.max(rvs) <= achievable_rv_lim:
-                print('Max rv is {}. Assuming this was a good fit'.format(
-                    np.max(rvs)))
-                tdum['achievable_rvs_good'] = True
-            else:
-                print('Max rv is {}. Assuming this was a bad fit'.format(
-                    np.max(rvs)))
-        except IOError:
-            print('No output achievable_rvs output found. Assuming theyre bad.\
+            stat = os.stat(pn)
+            fingerprint.append([stat.st_mtime, stat.st_size])
+        except OSError:
+            fingerprint.append(None)
+    return fingerprint
+
+
+def _concat_results(tables):
+    '''Concatenate the tables of the proc directories once and apply the
+    dtypes'''
+    if len(tables) == 0:
+        return pd.DataFrame(columns=tentries)
+    t_obs = pd.concat(tables, ignore_index=True, sort=False)
+    t_obs = t_obs.astype({tentry: dtype for tentry, dtype in zip(tentries, dtypes)
+                          if dtype is not str})
+    return t_obs[tentries + [col for col in t_obs.columns if col not in tentries]]
+
+
+def _read_procdir(procdir):
+    '''Read the results.txt of a proc directory and check the achievable rvs.
+    Returns a DataFrame or None if there are no results'''
+    fnresults = os.path.join(procdir, 'results.txt')
+    par_dir = os.path.abspath(os.path.normpath(os.path.join(
+        procdir, os.pardir)))
+    fnachievable_rvs = os.path.join(par_dir, 'achievable_rvs.txt')
+    try:
+        tdum = pd.read_csv(fnresults, sep=r'\s+', header=None,
+                           names=tentries[-nceres:])
+    except IOError:
+        print('Coudnt find {}'.format(fnresults))
+        return None
+    except ValueError:
+        print('The observations in {} were not analysed'.format(procdir),
+              'Probably no calibration files were found')
+        return None
+    tdum.insert(0, 'achievable_rvs_good', False)
+    # to update the rows of this directory later
+    tdum['resultspath'] = os.path.abspath(fnresults)
+    try:
+        with open(fnachievable_rvs, "r") as frv:
+            rvs = frv.read().strip().split('\n')
+        if rvs[0] == "":
+            rvs = [np.nan]
+        rvs = np.array([float(rv) for rv in rvs])
+        if np.max(rvs) <= achievable_rv_lim:
+            print('Max rv is {}. Assuming this was a good fit'.format(
+                np.max(rvs)))
+            tdum['achievable_rvs_good'] = True
+        else:
+            print('Max rv is {}. Assuming this was a bad fit'.format(
+                np.max(rvs)))
+    except IOError:
+        print('No output achievable_rvs output found. Assuming theyre bad.\
 ked here: {} )'.format(fnachievable_rvs))
+    return tdum
 
-            # try to get the activity_indicators
-            if activity_indicators:
-                for tobs in tdum:
-                    try:
-                        from starclass import Star
-                        star = Star(tobs['target'])
-                        pnspectrum = os.path.join(
-                            procdir,
-                            star.sname + Time(tobs['bjd'], format='jd').isot + '_sp.fits'
-                        )
-                        star.read_ceres_spectrum(pnspectrum)
-                        star.get_activity_indicators()
-                        actindics = star.activity_indicators()
-                        for aidx, valerr in actindics:
-                            tdum[aidx] = valerr[0]
-                            tdum[aidx+'err'] = valeer[1]
-                    except IOError:
-                        print('Couldnt get activity indicators since file {} not \
-found'.format(pnspectrum))
-                    except:
-                        print('Couldnt get activity indicator for {} for unknown \
-reasons'.format(tobs))
-                            
-        t_obs = vstack((t_obs,tdum), join_type='outer')
-    
-    pntable = os.path.join(log_dir, 'observation_summary.csv',)
-    t_obs.write(pntable, delimiter=',', overwrite=True)
-    print('Done with collect_rv_data.collect. Saved table in {}'.format(pntable))
 
-    
-def get_csv(target, plot=True, check_name=False):
+def get_csv(target, plot=True, check_name=False, par_dir=None, save_dir=None):
+    '''Collect the results.txt of target in a csv file (and plot its RVs)
+    par_dir=None
+    folder of the target folders. Uses the default_science_dir if None
+    save_dir=None
+    folder to store the results in. Uses the default_log_dir if None'''
+    if par_dir is None:
+        par_dir = default_science_dir
+    if save_dir is None:
+        save_dir = default_log_dir
     for ddir in [par_dir, save_dir]:
         if not os.path.exists(ddir):
             os.mkdir(ddir)
-    direct = par_dir+target+'/'
+    direct = os.path.join(par_dir, target)
     # res_files = []
     columns = ['Name', 'BJD', 'RV', 'sig_RV', 'bisector_span', 'sig_bisector_span',
                                     'inst', 'pipeline', 'resolving_power', 'Teff', 'logg', '[Fe_H]',
                                     'vsini', 'continuumCCF', 'sig_gaussian_CCF', 'Texp','SNR5150',
                                     'path_pdf']
-    table = pd.DataFrame(columns=columns)
+    tables = []
     for root, subdirs, files in os.walk(direct):
         for f in files:
             if f == 'results.txt':
                 table_dum = pd.read_csv(root+'/'+f, names=columns, sep="\s+")
                 if check_name:
-                    table = table.append(table_dum.loc[lambda x: x.Name == target])
+                    tables.append(table_dum.loc[lambda x: x.Name == target])
                 else:
-                    table = table.append(table_dum)
+                    tables.append(table_dum)
+    if len(tables) == 0:
+        table = pd.DataFrame(columns=columns)
+    else:
+        table = pd.concat(tables)
     table = table.reset_index()
     table.RV = 1000* table.RV  # km/s to m/s
     table.sig_RV = 1000*table.sig_RV
-    table.to_csv(save_dir+target+'_results.csv', sep=',', index=False)
-    with open(save_dir+target+'_results.csv', 'a') as myfile:
+    pnresults = os.path.join(save_dir, target+'_results.csv')
+    table.to_csv(pnresults, sep=',', index=False)
+    with open(pnresults, 'a') as myfile:
         myfile.write('#RV[m/s]: %d +- %d \n'%(np.mean(table.RV),np.std(table.RV)))
         myfile.write('#vsini[km/s]: %d +- %d \n'%(np.mean(table.vsini),np.std(table.vsini)))
     
@@ -162,60 +504,120 @@ def get_csv(target, plot=True, check_name=False):
         ax.set_xlabel('BJD')
         ax.set_ylabel('RV [m/s]')
         ax.set_title(target+' (#='+str(len(table.RV))+', RV: '+str(np.mean(table.RV))+' +- '+str(np.std(table.RV))+')')
-        plt.savefig(save_dir+target+'_results.pdf')
+        plt.savefig(os.path.join(save_dir, target+'_results.pdf'))
     
     print('Done :)')
 
                 
 
 
-def merge_final_CCF(parent_directory, plot_dir=None):
+def merge_final_CCF(parent_directory, plot_dir=None, nworkers=None,
+                    batchsize=200, force=False):
     '''Only store the second page of the CCF:
     Collect all *.pdf files in a proc-folder in a subdirectory of parent dir
     and extract the
     CCF functions CERES returns. Sort those by target and collect them in
-    a big pdf.'''
+    a big pdf.
+    nworkers=None
+    number of processes extracting and annotating the pages. Uses all cpus
+    if None
+    batchsize=200
+    number of pages extracted and held in memory at the same time. Each
+    source pdf is closed as soon as its page is extracted and each batch is
+    written to disk before the next one
+    force=False
+    Targets whose pdfs did not change since the last run (stored in
+    CCF_state.json in the plot_dir) are skipped. Set to True to merge all'''
     from PyPDF2 import PdfFileReader, PdfFileWriter
-    from reportlab.pdfgen import canvas
-    from reportlab.lib.pagesizes import letter
 
     if plot_dir is None:
         plot_dir=parent_directory
     pnpdfs = glob(os.path.join(parent_directory, '**/proc/*.pdf'), recursive=True)
+    if len(pnpdfs) == 0:
+        print('No pdfs found in {}'.format(parent_directory))
+        return
     fnpdfs = [pn.split('/')[-1] for pn in pnpdfs]
     tarnames = ['_'.join(fn.split('.')[-2].split('_')[0:-2]) for fn in fnpdfs]
-    times = [Time(fn.split('.')[1], format='isot') for fn in fnpdfs]
+    times = Time([fn.split('.')[1] for fn in fnpdfs], format='isot')
     tpdfs = Table([tarnames, times, fnpdfs, pnpdfs],
                   names=['target', 'time','pdfname', 'pdfpath'])
     tpdfs = tpdfs.group_by('target')
 
-    for tgroup in tpdfs.groups:
-        tgroup.sort('time')
-        tarname = tgroup['target'][0]
-        output = PdfFileWriter()
-        print('Processing {} ({} files)'.format(tarname, len(tgroup)))
-        ccfs = []
-        openfiles = []
-        for time, pdfpath in tgroup[['time', 'pdfpath']]:
-             openfiles.append(open(pdfpath, 'rb'))
-             page = PdfFileReader(openfiles[-1]).getPage(1)
-             page.cropBox.lowerLeft = (12, 5)
-             page.cropBox.upperRight = (418, 305)
-             output.addPage(page)
-
-             # add the text
-             packet = io.BytesIO()
-             # create a new PDF with Reportlab
-             can = canvas.Canvas(packet, pagesize=letter)
-             can.drawString(280, 45, time.iso)
-             can.save()
-            
-             #move to the beginning of the StringIO buffer
-             packet.seek(0)
-             textpdf = PdfFileReader(packet)
-             page.mergePage(textpdf.getPage(0))
-
-        with open(os.path.join(plot_dir, '{}_CCFs.pdf'.format(tarname)), 'wb') as out_pdf:
-            output.write(out_pdf)
-        for of in openfiles:
-            of.close()
+    pnstate = os.path.join(plot_dir, 'CCF_state.json')
+    state = {}
+    if os.path.exists(pnstate):
+        with open(pnstate, 'r') as fstate:
+            state = json.load(fstate)
+    with ProcessPoolExecutor(max_workers=nworkers) as pool:
+        for tgroup in tpdfs.groups:
+            tgroup.sort('time')
+            tarname = tgroup['target'][0]
+            pnout = os.path.join(plot_dir, '{}_CCFs.pdf'.format(tarname))
+            fingerprint = _pdfs_fingerprint(tgroup['pdfpath'])
+            if not force and state.get(tarname) == fingerprint and \
+               os.path.exists(pnout):
+                print('Skipping {}. Its pdfs did not change'.format(tarname))
+                continue
+            print('Processing {} ({} files)'.format(tarname, len(tgroup)))
+            jobs = [(str(pdfpath), time.iso) for time, pdfpath in
+                    zip(tgroup['time'], tgroup['pdfpath'])]
+            # write each batch to a part file, so only one batch of pages is
+            # in memory. Then merge the parts as in get_pdfs
+            parts = []
+            for ii in range(0, len(jobs), batchsize):
+                output = PdfFileWriter()
+                for pagebytes in pool.map(_ccf_page, jobs[ii:ii+batchsize]):
+                    output.addPage(PdfFileReader(io.BytesIO(pagebytes)).getPage(0))
+                parts.append(pnout + '.part{}'.format(ii // batchsize))
+                with open(parts[-1], 'wb') as out_pdf:
+                    output.write(out_pdf)
+                del output
+            if len(parts) == 1:
+                os.replace(parts[0], pnout+'.tmp')
+            else:
+                _merge_pdfs(parts, pnout+'.tmp')
+                for pnpart in parts:
+                    os.remove(pnpart)
+            os.replace(pnout+'.tmp', pnout)
+            state[tarname] = fingerprint
+            with open(pnstate, 'w') as fstate:
+                json.dump(state, fstate, indent=1)
+
+
+def _ccf_page(job):
+    '''The cropped CCF page (the second one) of a CERES pdf, annotated with
+    the time, as bytes of a single page pdf'''
+    from PyPDF2 import PdfFileReader, PdfFileWriter
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import letter
+    pdfpath, timeiso = job
+    with open(pdfpath, 'rb') as fpdf:
+        page = PdfFileReader(fpdf).getPage(1)
+        page.cropBox.lowerLeft = (12, 5)
+        page.cropBox.upperRight = (418, 305)
+
+        # add the text
+        packet = io.BytesIO()
+        # create a new PDF with Reportlab
+        can = canvas.Canvas(packet, pagesize=letter)
+        can.drawString(280, 45, timeiso)
+        can.save()
+
+        #move to the beginning of the StringIO buffer
+        packet.seek(0)
+        textpdf = PdfFileReader(packet)
+        page.mergePage(textpdf.getPage(0))
+        single = PdfFileWriter()
+        single.addPage(page)
+        pagebytes = io.BytesIO()
+        single.write(pagebytes)
+    return pagebytes.getvalue()
+
+
+def _pdfs_fingerprint(pnpdfs):
+    '''path, mtime and size of the pdfs'''
+    fingerprint = []
+    for pn in sorted([str(pn) for pn in pnpdfs]):
+        stat = os.stat(pn)
+        fingerprint.append([os.path.abspath(pn), stat.st_mtime, stat.st_size])
+    return fingerprint
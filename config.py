@@ -17,3 +17,13 @@ default_astroquery_dir = '/data/beegfs/astro-storage/groups/launhardt/RVSPY/astr
 default_eso_user = "zkholga"
 # only get data after that date. E.g. after 2005-09-30 where there was a major intervention
 default_startdate = '2005-09-30'
+# cache the archive queries for this many days. Set to 0 to always query the archive
+default_query_cache_ttl = 7.  # in days
+# number of parallel downloads from the ESO archive
+default_download_workers = 4
+# how to put the downloaded files into the night folders: 'hardlink',
+# 'reflink' or 'copy'. Links fall back to copies across filesystems
+default_link_mode = 'hardlink'
+# the ESO archive query form and how many queries to run at the same time
+default_eso_query_url = 'http://archive.eso.org/wdb/wdb/eso/eso_archive_main/query'
+default_query_concurrency = 4
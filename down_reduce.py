@@ -1,54 +1,75 @@
-from download_sort import full_download
-from run_feros_pipeline import all_subfolders
+from concurrent.futures import ThreadPoolExecutor
+from download_sort import campaign_download
+from run_feros_pipeline import reduce_folder, reduction_inputs
+from work_queue import fill_queue, run_worker, queue_status
 
 
 targets = [
     'HD_25457',
     'HD_10700'
 ]
+ignore_targets = []
 
-def download(store_pwd=True):
+def download(store_pwd=True, refresh_queries=False, clear_cache=False,
+             stream=False, max_scratch_gb=None):
+    '''Download all targets in one campaign, so the calibration of nights
+    shared by several targets is only searched and downloaded once.
+    clear_cache=False
+    clear the download folder afterwards. On the cluster I have only
+    limited space there
+    stream=False, max_scratch_gb=None
+    distribute the files while downloading and keep at most max_scratch_gb
+    in the download folder'''
     for ii, target in enumerate(targets):
-        target = target.replace(' ', '_')
-        targets[ii] = target
-        print('DOWNOLADING target %s (%d of %d)' %
-              (target, ii, len(targets) - 1))
-        print('###########################################')
-        clear_cache = False
-        # if ii%6 == 5:
-        #   clear_cache = True  # clear the download folder. On the cluster I have only
-        # limited space there
-        if target not in ignore_targets:
-            full_download(target, store_pwd=store_pwd,
-                          overwrite_old='y', clear_cache=clear_cache)
+        targets[ii] = target.replace(' ', '_')
+    down_targets = [target for target in targets if target not in ignore_targets]
+    print('DOWNOLADING {} targets'.format(len(down_targets)))
+    print('###########################################')
+    campaign_download(down_targets, store_pwd=store_pwd,
+                      overwrite_old='y', clear_cache=clear_cache,
+                      refresh_queries=refresh_queries, stream=stream,
+                      max_scratch_gb=max_scratch_gb)
     print('Downloaded data and calib for all {} targets :)'.format(len(targets)))
 
 
-def reduce(mod=None, do_class=False, npools=5):
+def reduce(do_class=False, npools=5, ncores=None, force=False, pnqueue=None,
+           reset=False):
+    '''Reduce the night folders of all targets. Start this on as many nodes as
+    you like: the (target, night) units are handed out by a queue on the shared
+    storage (work_queue.sqlite in the log_dir if pnqueue is None), largest
+    first. Units of crashed nodes are handed out again.
+    ncores=None
+    total number of cores of this node. ncores//npools folders are reduced
+    in parallel. One at a time if None
+    reset=False
+    hand out all folders again, see fill_queue. Folders which changed since
+    their reduction are queued again anyway'''
     if do_class:
         print('PROCESSING {} targets WITH spectral classification. \
 This takes some time.'.format(len(targets)))
     else:
         print('PROCESSING {} targets withOUT spectral classification. \
 This is a bit faster than with.'.format(len(targets)))
-    for ii, target in enumerate(targets):
+    for target in targets:
         if target in ignore_targets:
             print('Ignoring target {} as its in the ignore list'.format(target))
-        else:
-            if mod is None:
-                print('PROCESSING target %s (%d of %d)' % (target, ii,
-                                                           len(targets)))
-                print('###########################################')
-                print('(Processing all targets)')
-                all_subfolders(target, show_pdfs=False, do_class=do_class,
-                               npools=npools)
-            else:
-                if ii % 4 == mod:
-                    print('PROCESSING target %s (%d of %d)' % (target, ii,
-                                                               len(targets)))
-                    print('###########################################')
-                    print('(Processing targets modulo %d)' % mod)
-                    all_subfolders(target, show_pdfs=False,
-                                   do_class=do_class,
-                                   npools=npools)
+    red_targets = [target.replace(' ', '_') for target in targets
+                   if target not in ignore_targets]
+    fill_queue(pnqueue, targets=red_targets, reset=reset)
+    nworkers = 1 if ncores is None else max(1, ncores // npools)
+    # read the logs and resolve the targets only once for all folders
+    inputs = reduction_inputs()
+
+    def reduce_unit(target, night_dir):
+        print('PROCESSING night {} of target {}'.format(night_dir, target))
+        print('###########################################')
+        return reduce_folder(night_dir, npools=npools, do_class=do_class,
+                             force=force, **inputs)
+
+    with ThreadPoolExecutor(max_workers=nworkers) as pool:
+        futures = [pool.submit(run_worker, reduce_unit, pnqueue=pnqueue)
+                   for ii in range(nworkers)]
+        for future in futures:
+            future.result()
+    queue_status(pnqueue)
     print('Wohooo!!!')
@@ -2,18 +2,39 @@ import os
 import sys
 import datetime
 import time
+import sqlite3
+import hashlib
+import gzip
+import shutil
+import errno
+import fcntl
 import numpy as np
-import pandas as pd
 from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    as_completed, wait, FIRST_COMPLETED
 from astroquery.eso import Eso
-from subprocess import call
+from subprocess import call, check_call
 from astropy.time import Time
 from shutil import copyfile
 from warnings import warn
 from glob import glob
-from misc import find_night
+from misc import find_nights, process_pool, locked, tmp_name
+import eso_query
 from config import default_science_dir, default_calib_dir, default_log_dir, \
-    default_astroquery_dir, default_eso_user, default_startdate
+    default_astroquery_dir, default_eso_user, default_startdate, \
+    default_query_cache_ttl, default_download_workers, default_link_mode, \
+    default_query_concurrency
+
+try:
+    # in-process LZW (.Z) codec. Falls back to compress/uncompress if missing
+    import ncompress
+except ImportError:
+    ncompress = None
+
+# start of the new calibration plan (2017-12-13T12:00)
+new_calib_mjd = 58100.5
+# hit/miss counters of the query cache of this session
+query_cache_stats = {'hit': 0, 'miss': 0}
 
 if __name__ == '__main__':
     full_download(sys.argv)
@@ -32,7 +53,12 @@ def full_download(target, extract=True, store_pwd=False,
                   sort_sciencefiles_by_target=False,
                   query_radius="08+00",  # in "mm+ss"
                   startdate=None,
-                  enddate="", ):
+                  enddate="",
+                  refresh_queries=False,
+                  download_workers=None,
+                  link_mode=None,
+                  stream=False,
+                  max_scratch_gb=None):
     '''Main function. Run this to get all FEROS science files and the corresponding caibration
     files for each night (5 BIAS, 10 flats, 6 or 12 wave calib). If there is anything off this standard
     calibration, no calib files are downloaded and the corresponding nights are stored in a file
@@ -51,7 +77,73 @@ def full_download(target, extract=True, store_pwd=False,
     unrobust_calibfiles=True
     set to True, to download all the calibfiles of the day, if the important ones
     couldnt be determined automatically. An output of which folders had trouble is
-    written out.'''
+    written out.
+    refresh_queries=False
+    set to True to ignore the cached archive queries and query the archive again
+    download_workers=None
+    number of parallel downloads. Uses default_download_workers if None
+    link_mode=None
+    'hardlink', 'reflink' or 'copy' the files from the astroquery_dir. Uses
+    default_link_mode if None
+    stream=False, max_scratch_gb=None
+    distribute and extract each file as soon as it is downloaded, keeping at
+    most max_scratch_gb in the astroquery_dir. See campaign_download'''
+    return campaign_download([target, ], extract=extract, store_pwd=store_pwd,
+                             overwrite_old=overwrite_old,
+                             clear_cache=clear_cache,
+                             astroquery_dir=astroquery_dir,
+                             calib_dir=calib_dir,
+                             science_dir=science_dir,
+                             log_dir=log_dir,
+                             eso_user=eso_user,
+                             unrobust_calibfiles=unrobust_calibfiles,
+                             flat_min_exptime=flat_min_exptime,
+                             sort_calibfiles_by_target=sort_calibfiles_by_target,
+                             sort_sciencefiles_by_target=sort_sciencefiles_by_target,
+                             query_radius=query_radius,
+                             startdate=startdate,
+                             enddate=enddate,
+                             refresh_queries=refresh_queries,
+                             download_workers=download_workers,
+                             link_mode=link_mode,
+                             stream=stream,
+                             max_scratch_gb=max_scratch_gb)
+
+
+def campaign_download(targets, extract=True, store_pwd=False,
+                      overwrite_old="ask", clear_cache=False,
+                      astroquery_dir=None,
+                      calib_dir=None,
+                      science_dir=None,
+                      log_dir=None,
+                      eso_user=None,
+                      unrobust_calibfiles=True,
+                      flat_min_exptime=.8,  # in sec
+                      sort_calibfiles_by_target=False,
+                      sort_sciencefiles_by_target=False,
+                      query_radius="08+00",  # in "mm+ss"
+                      startdate=None,
+                      enddate="",
+                      refresh_queries=False,
+                      download_workers=None,
+                      link_mode=None,
+                      stream=False,
+                      max_scratch_gb=None):
+    '''Same as full_download, but for a list of targets. The science nights of all
+    targets are collected first, so the calibration of a night is searched only
+    once, even if several targets were observed in it. All files are then
+    downloaded in one go and distributed to the folders of each target. The
+    science_files.csv log is written for each target as in full_download.
+    See full_download for the keywords.
+    stream=False
+    If True, each downloaded chunk is validated, distributed and extracted right
+    away instead of downloading everything first. Files which are in all their
+    folders already are not downloaded again.
+    max_scratch_gb=None
+    Only with stream=True. No new downloads are started while the files
+    downloaded in this run hold more than this (in GB) in the astroquery_dir.
+    The files are removed from it once they are distributed, also those which
+    were in it already.'''
     # load the default values if noothers were given
     if startdate is None:
         startdate=default_startdate
@@ -66,181 +158,446 @@ def full_download(target, extract=True, store_pwd=False,
         science_dir = default_science_dir
     if log_dir is None:
         log_dir = default_log_dir
+    assert len(query_radius) == 5
 
-    if sort_calibfiles_by_target:
-        calib_dir = os.path.join(calib_dir, target)
-    if sort_sciencefiles_by_target:
-        science_dir = os.path.join(science_dir, target)
-    # file of the query result.e.g. which files are gonna be downloaded
-    fn_query = "last_output_query.csv"
+    tar_calib_dir = {}
+    tar_science_dir = {}
+    tar_id2nights = {}
+    tar_science_ids = {}
+    tar_nights = {}
+    tar_failed_calib_nights = {}
+    # the nights of all targets by their date
+    all_nights = {}
+    # the science files of all targets at the same time
+    t_sciences = query_eso_many([{'target': target, 'category': 'SCIENCE',
+                                  'sdate': startdate, 'edate': enddate}
+                                 for target in targets],
+                                refresh=refresh_queries, cache_dir=astroquery_dir)
+    for target, t_science in zip(targets, t_sciences):
+        tar_calib_dir[target] = calib_dir
+        tar_science_dir[target] = science_dir
+        if sort_calibfiles_by_target:
+            tar_calib_dir[target] = os.path.join(calib_dir, target)
+        if sort_sciencefiles_by_target:
+            tar_science_dir[target] = os.path.join(science_dir, target)
 
-    t_science = query_eso(target, category='SCIENCE', 
-                          sdate=startdate, edate=enddate,
-                          fn_query=fn_query)
+        for outdir in [tar_calib_dir[target], tar_science_dir[target],
+                       astroquery_dir]:
+            if outdir is not None:
+                if not os.path.exists(outdir):
+                    os.makedirs(outdir)
 
-    for outdir in [calib_dir, science_dir, astroquery_dir]:
-        if outdir is not None:
-            if not os.path.exists(outdir):
-                os.makedirs(outdir)
+        id2nights, science_ids, nights = _science_nights(t_science)
+        print('Found %d science obs in %d different nights for %s.' % (
+            len(t_science), len(nights), target))
+        tar_id2nights[target] = id2nights
+        tar_science_ids[target] = science_ids
+        tar_nights[target] = nights
+        tar_failed_calib_nights[target] = []
+        for night in nights:
+            all_nights[night.iso[:10]] = night
 
-    assert len(query_radius) == 5
-    # find the different date. Look for morning/evening and adjust date!
-    nights = []
-    failed_calib_nights = []
-    calib_ids = []
-    # for some reason ESO misses some downloads sometimes,
-    # Even if theyre in the confirmation mail. catch them
-    # edit: mostly those are files already in the cache.
-    missing_downloads = []
-    id2nights = {}
-    science_ids = []
-    # get the right night for the science file
-    for science_id, dtime in zip(t_science['Dataset ID'], 
-                                 t_science['MJD-OBS']):
-        science_ids.append(science_id)
-        night = find_night(dtime)
-        if science_id in id2nights.keys():
-            id2nights[science_id] = id2nights[science_id] + [night,]
-        else:
-            id2nights[science_id] = [night, ]
-        nights.append(night)
-    nights = np.unique(nights)
-    print('Found %d science obs in %d different nights.' % (len(t_science),
-                                                            len(nights)))
-
-    for night in nights:
-        ddir = os.path.join(calib_dir, night.iso[:10].replace("-", ""))
-        if not os.path.exists(ddir):
-            os.mkdir(ddir)
-#        os.chdir(ddir)
-        these_calib_ids, these_failed_calib = get_calib(
-            night,
-            flat_min_exptime=flat_min_exptime,
-            unrobust_calibfiles=unrobust_calibfiles)
-
-        calib_ids.append(these_calib_ids)
-        failed_calib_nights += these_failed_calib
-
-        for tcalib_id in these_calib_ids:
-            if tcalib_id in id2nights.keys():
-                id2nights[tcalib_id] = id2nights[tcalib_id] + [night, ]
-            else:
-                id2nights[tcalib_id] = [night, ]
-    
+    # one query for many nights instead of one per night. Also each night only
+    # once, even if several targets were observed
+    nights = [all_nights[date] for date in sorted(all_nights.keys())]
+    print('Searching calibration files for {} different nights of {} targets'.format(
+        len(nights), len(targets)))
+    calib_nights = get_calib_nights(nights,
+                                    flat_min_exptime=flat_min_exptime,
+                                    unrobust_calibfiles=unrobust_calibfiles,
+                                    refresh=refresh_queries,
+                                    cache_dir=astroquery_dir)
+    night2calib = dict(zip(sorted(all_nights.keys()), calib_nights))
+    for target in targets:
+        id2nights = tar_id2nights[target]
+        for night in tar_nights[target]:
+            these_calib_ids, these_failed_calib = night2calib[night.iso[:10]]
+            ddir = os.path.join(tar_calib_dir[target],
+                                night.iso[:10].replace("-", ""))
+            if not os.path.exists(ddir):
+                os.mkdir(ddir)
+
+            tar_failed_calib_nights[target] += these_failed_calib
 
-    print('Downloading the %d files for target %s' % (len(id2nights.keys()),
-                                                      target))
-    astroquery_dir = download_id(id2nights.keys(), eso_user, store_pwd=store_pwd,
-                                 astroquery_dir=astroquery_dir)
+            for tcalib_id in these_calib_ids:
+                if tcalib_id in id2nights.keys():
+                    id2nights[tcalib_id] = id2nights[tcalib_id] + [night, ]
+                else:
+                    id2nights[tcalib_id] = [night, ]
 
-    print('Downloaded')
+    # the ids of all targets without duplicates
+    all_ids = list(dict.fromkeys([iid for target in targets
+                                  for iid in tar_id2nights[target].keys()]))
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
     fn_failed = os.path.join(log_dir, 'failed_calib_searches.csv')
     with open(fn_failed, 'a') as f_failed:
-        for failed_night in failed_calib_nights:
-            f_failed.write("{}, {}, {}\n".format(target, failed_night,
-                                               datetime.date.today()))
+        for target in targets:
+            for failed_night in tar_failed_calib_nights[target]:
+                f_failed.write("{}, {}, {}\n".format(target, failed_night,
+                                                     datetime.date.today()))
+    fn_scfiles = os.path.join(log_dir, 'science_files.csv')
+    min_filesize = 100*1000  # in bit
 
-    compress_files(astroquery_dir, fileending='.fits')
+    if stream:
+        # no need to download what is in its folders already
+        len_before = len(all_ids)
+        all_ids = [iid for iid in all_ids if not all(
+            [_is_distributed(iid, tar_id2nights[target], tar_calib_dir[target],
+                             tar_science_dir[target], tar_science_ids[target])
+             for target in targets if iid in tar_id2nights[target]])]
+        print('{} of the {} files are in their folders already'.format(
+            len_before - len(all_ids), len_before))
+        if max_scratch_gb is not None:
+            max_scratch_bytes = max_scratch_gb * 1e9
+        else:
+            max_scratch_bytes = None
+        extract_state = {'overwrite_old': overwrite_old}
+        if astroquery_dir is None:
+            astroquery_dir = Eso().cache_location
+        pnmanifest = os.path.join(astroquery_dir, 'download_manifest.txt')
+        # one pool for all chunks, started before the download threads
+        codec_pool = _codec_pool()
 
-    if True:
-        min_filesize = 100*1000  # in bit
-        print('Deleting fits files smaller than {} kb. Assuming errors during \
-the download. They will be downloaded again'.format(min_filesize//1000))
-        delete_small_files(astroquery_dir, min_filesize,
-                           fileendings=['.fits', '.fits.Z'])
+        def process_retrieved(ids):
+            '''validate, distribute and extract the ids as soon as they arrive'''
+            _prepare_cache(astroquery_dir, min_filesize, ids=ids, pool=codec_pool)
+            placed = []
+            missing = []
+            for target in targets:
+                tids = [iid for iid in ids if iid in tar_id2nights[target]]
+                tmissing = _distribute_target(
+                    target, tids, tar_id2nights[target], astroquery_dir,
+                    tar_calib_dir[target], tar_science_dir[target],
+                    tar_science_ids[target], fn_scfiles, link_mode=link_mode)
+                missing += tmissing
+                placed += [pn for iid in tids if iid not in tmissing for pn in
+                           _destinations(iid, tar_id2nights[target],
+                                         tar_calib_dir[target],
+                                         tar_science_dir[target],
+                                         tar_science_ids[target])
+                           if os.path.isfile(pn)]
+            if extract and len(placed) > 0:
+                extract_state['overwrite_old'] = extract_files(
+                    direct=astroquery_dir, filelist=placed,
+                    overwrite_old=extract_state['overwrite_old'],
+                    pool=codec_pool)
+            if max_scratch_bytes is not None:
+                # free the scratch space for the next downloads
+                evicted = []
+                for iid in ids:
+                    pncache = os.path.join(astroquery_dir, iid+'.fits.Z')
+                    if iid not in missing and os.path.isfile(pncache):
+                        os.remove(pncache)
+                        evicted.append(iid)
+                _update_manifest(pnmanifest, remove=evicted)
 
-    print('Moving files to the appropriate directories')
-    # for fpath in downloaded:
-    missing_downloads, science_files = distribute_files(
-        id2nights.keys(),
-        id2nights,
-        astroquery_dir,
-        calib_dir, science_dir,
-        science_ids=science_ids)
+        print('Downloading and distributing the %d files for %d targets' % (
+            len(all_ids), len(targets)))
+        with codec_pool:
+            astroquery_dir = download_id(all_ids, eso_user, store_pwd=store_pwd,
+                                         astroquery_dir=astroquery_dir,
+                                         nworkers=download_workers,
+                                         on_retrieved=process_retrieved,
+                                         max_scratch_bytes=max_scratch_bytes)
+        overwrite_old = extract_state['overwrite_old']
+    else:
+        print('Downloading the %d files for %d targets' % (len(all_ids),
+                                                           len(targets)))
+        astroquery_dir = download_id(all_ids, eso_user, store_pwd=store_pwd,
+                                     astroquery_dir=astroquery_dir,
+                                     nworkers=download_workers)
+        print('Downloaded')
+        _prepare_cache(astroquery_dir, min_filesize)
 
-    # save the science file logs for later identification
-    fn_scfiles = os.path.join(log_dir, 'science_files.csv')
-    with open(fn_scfiles, 'a') as f_scfiles:
-        for scf in science_files:
-            f_scfiles.write("{}, {}, {}\n".format(target, scf,                                                          datetime.date.today()))
+    print('Moving files to the appropriate directories')
+    # for some reason ESO misses some downloads sometimes,
+    # Even if theyre in the confirmation mail. catch them
+    # edit: mostly those are files already in the cache.
+    tar_missing = {}
+    for target in targets:
+        tar_missing[target] = _distribute_target(
+            target, tar_id2nights[target].keys(), tar_id2nights[target],
+            astroquery_dir, tar_calib_dir[target], tar_science_dir[target],
+            tar_science_ids[target], fn_scfiles, link_mode=link_mode)
 
+    missing_downloads = list(dict.fromkeys(
+        [iid for target in targets for iid in tar_missing[target]]))
     while (len(missing_downloads) >= 1):
         old_len_missing = len(missing_downloads)
         print('%d files got lost on the way. Try to redownload them...' %
               (old_len_missing))
         astroquery_dir = download_id(missing_downloads, eso_user,
                                      astroquery_dir=astroquery_dir,
-                                     store_pwd=store_pwd)
-        compress_files(astroquery_dir, fileending='.fits')
-        if True:
-            print('Deleting fits files smaller than {} kb. Assuming errors during \
-the download. They will be downloaded again'.format(min_filesize//1000))
-            delete_small_files(astroquery_dir, min_filesize,
-                               fileendings=['.fits', '.fits.Z'])
-
-        missing_downloads, science_files2 = distribute_files(
-            missing_downloads,
-            id2nights,
-            astroquery_dir,
-            calib_dir, science_dir,
-            science_ids=science_ids)
-        # science_files = np.unique(science_files + science_files2)
+                                     store_pwd=store_pwd,
+                                     nworkers=download_workers)
+        _prepare_cache(astroquery_dir, min_filesize)
+
+        for target in targets:
+            tar_missing[target] = _distribute_target(
+                target, tar_missing[target], tar_id2nights[target],
+                astroquery_dir, tar_calib_dir[target], tar_science_dir[target],
+                tar_science_ids[target], fn_scfiles, link_mode=link_mode)
+        missing_downloads = list(dict.fromkeys(
+            [iid for target in targets for iid in tar_missing[target]]))
         if old_len_missing == len(missing_downloads):
             fn_failed_down = os.path.join(log_dir,
                                           'failed_download_files.csv')
 
             with open(fn_failed_down, 'a') as f_failed_down:
-                for failed_down in missing_downloads:
-                    f_failed_down.write("{}, {}, {}\n".format(target, failed_down,
-                                                              datetime.date.today()))
-            with open(fn_scfiles, 'a') as f_scfiles:
-                for scf in science_files2:
-                    f_scfiles.write("{}, {}, {}\n".format(target, scf,
-                                                          datetime.date.today()))
+                for target in targets:
+                    for failed_down in tar_missing[target]:
+                        f_failed_down.write("{}, {}, {}\n".format(
+                            target, failed_down, datetime.date.today()))
             print('Could not download %d files. Please download them manually. \
 Probably they are proprietary. You find them in %s' % (old_len_missing, fn_failed_down))
             break
     print('Done downloading %d files. Had problems with %d nights (stored in %s)'
-          % (len(id2nights.keys()), len(failed_calib_nights), fn_failed))
+          % (len(all_ids),
+             sum([len(failed) for failed in tar_failed_calib_nights.values()]),
+             fn_failed))
 
     if extract:
-        overwrite_old = extract_files(direct=os.path.join(calib_dir),
-                      overwrite_old=overwrite_old)
-        overwrite_old = extract_files(direct=os.path.join(science_dir),
-                      overwrite_old=overwrite_old)
+        extract_dirs = list(dict.fromkeys(
+            [tar_calib_dir[target] for target in targets] +
+            [tar_science_dir[target] for target in targets]))
+        for extract_dir in extract_dirs:
+            overwrite_old = extract_files(direct=extract_dir,
+                                          overwrite_old=overwrite_old)
     if clear_cache:
-        cachefiles = os.listdir(astroquery_dir)
+        # only the downloaded files, keep the query cache and the manifest
+        cachefiles = [ff for ff in os.listdir(astroquery_dir)
+                      if ff.endswith('.fits') or ff.endswith('.fits.Z')]
         for cfile in cachefiles:
             os.remove(os.path.join(astroquery_dir, cfile))
-    print('Done with with all for target {}  :)'.format(target))
+    print('Done with with all for targets {}  :)'.format(', '.join(targets)))
+
+
+def _science_nights(t_science):
+    '''Find the night of each science file. Returns the dict of the ids and
+    their nights, the list of science ids and the unique nights'''
+    # find the different date. Look for morning/evening and adjust date!
+    night_ids = find_nights(np.asarray(t_science['MJD-OBS'], dtype=float))
+    # only one Time per night
+    night_times = {}
+    for night_id in np.unique(night_ids):
+        night_times[night_id] = Time(float(night_id), format='mjd')
+    id2nights = {}
+    science_ids = []
+    # get the right night for the science file
+    for science_id, night_id in zip(t_science['Dataset ID'], night_ids):
+        science_ids.append(science_id)
+        night = night_times[night_id]
+        if science_id in id2nights.keys():
+            id2nights[science_id] = id2nights[science_id] + [night,]
+        else:
+            id2nights[science_id] = [night, ]
+    nights = [night_times[night_id] for night_id in sorted(night_times.keys())]
+    return id2nights, science_ids, nights
+
+
+def _prepare_cache(astroquery_dir, min_filesize, ids=None, pool=None):
+    '''Compress the downloaded files and remove broken ones. Only the files of
+    ids if given. pool is passed to compress_files'''
+    if ids is None:
+        compress_files(astroquery_dir, fileending='.fits')
+        print('Deleting fits files smaller than {} kb. Assuming errors during \
+the download. They will be downloaded again'.format(min_filesize//1000))
+        delete_small_files(astroquery_dir, min_filesize,
+                           fileendings=['.fits', '.fits.Z'])
+    else:
+        compress_files(astroquery_dir, fileending='.fits',
+                       filelist=[os.path.join(astroquery_dir, iid+'.fits')
+                                 for iid in ids], pool=pool)
+        for iid in ids:
+            pncache = os.path.join(astroquery_dir, iid+'.fits.Z')
+            if os.path.isfile(pncache) and os.path.getsize(pncache) < min_filesize:
+                print('Deleting {} as it is smaller than {} kb'.format(
+                    pncache, min_filesize//1000))
+                os.remove(pncache)
+
+
+def _destinations(iid, id2nights, calib_dir, science_dir, science_ids=[],
+                  fileending='.fits.Z'):
+    '''The paths the file of iid is distributed to'''
+    if iid in science_ids:
+        outdir = science_dir
+    else:
+        outdir = calib_dir
+    return [os.path.join(outdir, tnight.iso[:10].replace("-", ""), iid+fileending)
+            for tnight in id2nights[iid]]
+
+
+def _is_distributed(iid, id2nights, calib_dir, science_dir, science_ids=[]):
+    '''True if the file of iid is in all its folders, compressed or not'''
+    return all([os.path.isfile(pn) or os.path.isfile(pn[:-2]) for pn in
+                _destinations(iid, id2nights, calib_dir, science_dir,
+                              science_ids)])
+
+
+def _distribute_target(target, id_list, id2nights, astroquery_dir,
+                       calib_dir, science_dir, science_ids, fn_scfiles,
+                       link_mode=None):
+    '''Distribute the files of a target and save the science files in the log
+    for later identification. Returns the missing ids.'''
+    missing_downloads, science_files = distribute_files(
+        id_list,
+        id2nights,
+        astroquery_dir,
+        calib_dir, science_dir,
+        science_ids=science_ids,
+        link_mode=link_mode)
+    with open(fn_scfiles, 'a') as f_scfiles:
+        for scf in science_files:
+            f_scfiles.write("{}, {}, {}\n".format(target, scf,
+                                                  datetime.date.today()))
+    return missing_downloads
 
 
 def query_eso(target, instrument='FEROS', category='SCIENCE',
               sdate="", edate="", starttime="12", endtime="12",
               maxrows=999999, query_radius="08+00",
-              fn_query="last_output_query.csv"):
-    call(["wget", "-O", fn_query, "http://archive.eso.org/wdb/wdb/eso/eso_archive_main/query?tab_object=on&target=" + target.replace('+', '%2B') + "&resolver=simbad&tab_target_coord=on&ra=&dec=&box=00+"+query_radius+"&deg_or_hour=hours&format=SexaHours&tab_prog_id=on&prog_id=&tab_instrument=on&instrument=" +
-          instrument + "&stime=" + sdate + "&starttime=" + starttime + "&etime=" + edate + "&endtime=" + endtime + "&tab_dp_cat=true&dp_cat=" + category + "&top=" + str(maxrows) + "&wdbo=csv"])
-    try:
-        table = pd.read_csv(fn_query, comment='#', sep=',',
-                            skip_blank_lines=True)
-    except:
-        # make an empty table if the file was empty
-        table = pd.DataFrame(columns=['OBJECT', 'RA', 'DEC',
-                                      'Program_ID', 'Instrument',
-                                      'Category', 'Type', 'Mode',
-                                      'Dataset ID', 'Release_Date',
-                                      'TPL ID', 'TPL START',
-                                      'Exptime', 'Filter',
-                                      'MJD-OBS', 'Airmass'])
-    if category == 'SCIENCE':
-        # this is to remove any None lines the query sometimes returns. Dont check fo absolute values as airmass is not given for observations before 2003
-        table = table.loc[lambda x:x.Airmass != 0.]
+              fn_query=None, refresh=False, cache_ttl=None,
+              cache_dir=None, url=None):
+    '''Query the ESO archive and return the result as DataFrame. The results
+    are cached in an sqlite file in cache_dir (default_astroquery_dir if None).
+    Use query_eso_many to run several queries concurrently.
+    refresh=False
+    set to True to ignore the cached result and query the archive again
+    cache_ttl=None
+    the time in days a cached result is valid. Uses default_query_cache_ttl
+    if None
+    fn_query=None
+    file to store the raw query output in
+    url=None
+    url of the archive query form. Uses default_eso_query_url if None'''
+    query = {'target': target, 'instrument': instrument, 'category': category,
+             'sdate': sdate, 'edate': edate, 'starttime': starttime,
+             'endtime': endtime, 'maxrows': maxrows,
+             'query_radius': query_radius}
+    table = query_eso_many([query, ], refresh=refresh, cache_ttl=cache_ttl,
+                           cache_dir=cache_dir, fn_queries=[fn_query, ],
+                           url=url)[0]
     return table
 
 
+def query_eso_many(queries, refresh=False, cache_ttl=None, cache_dir=None,
+                   concurrency=None, fn_queries=None, url=None):
+    '''Run several archive queries concurrently. queries is a list of dicts
+    with the keywords of query_eso (target is needed, the others have the
+    defaults of query_eso). Returns the DataFrames in the same order. Cached
+    results are used as in query_eso. Failed queries (also error pages of the
+    archive) give empty DataFrames and are not cached.
+    concurrency=None
+    number of queries running at the same time. Uses default_query_concurrency
+    if None
+    url=None
+    passed to eso_query.fetch_csvs'''
+    if cache_ttl is None:
+        cache_ttl = default_query_cache_ttl
+    if concurrency is None:
+        concurrency = default_query_concurrency
+    if fn_queries is None:
+        fn_queries = [None, ] * len(queries)
+    queries = [eso_query.query_params(**query) for query in queries]
+    keys = ['|'.join([str(params[x]) for x in
+                      ['target', 'instrument', 'dp_cat', 'stime', 'starttime',
+                       'etime', 'endtime', 'top', 'box']] +
+                     ([] if url is None else [url]))
+            for params in queries]
+    pncache = _query_cache_path(cache_dir)
+    csvtexts = [None, ] * len(queries)
+    if pncache is not None and not refresh and cache_ttl > 0:
+        csvtexts = [_read_query_cache(pncache, key, cache_ttl) for key in keys]
+    todo = [ii for ii, csvtext in enumerate(csvtexts) if csvtext is None]
+    query_cache_stats['hit'] += len(queries) - len(todo)
+    query_cache_stats['miss'] += len(todo)
+    if len(todo) > 0:
+        fetched = eso_query.fetch_csvs([queries[ii] for ii in todo],
+                                       concurrency=concurrency, url=url)
+        for ii, csvtext in zip(todo, fetched):
+            # dont store failed queries, they would be replayed as empty
+            # results until the cache expires
+            if isinstance(csvtext, Exception):
+                print('Query of {} failed: {}'.format(keys[ii], csvtext))
+                csvtexts[ii] = ''
+                continue
+            if not eso_query.valid_csv(csvtext):
+                print('Query of {} returned no csv table: {}'.format(
+                    keys[ii], csvtext[:200]))
+                csvtexts[ii] = ''
+                continue
+            csvtexts[ii] = csvtext
+            if pncache is not None:
+                _write_query_cache(pncache, keys[ii], csvtext)
+    print('Query cache: {} hits, {} misses'.format(query_cache_stats['hit'],
+                                                   query_cache_stats['miss']))
+    tables = []
+    for params, csvtext, fn_query in zip(queries, csvtexts, fn_queries):
+        if fn_query is not None:
+            with open(fn_query, 'w') as fquery:
+                fquery.write(csvtext)
+        # make an empty table if the result was empty
+        table = eso_query.parse_csv(csvtext)
+        if params['dp_cat'] == 'SCIENCE':
+            # this is to remove any None lines the query sometimes returns. Dont check fo absolute values as airmass is not given for observations before 2003
+            table = table.loc[lambda x:x.Airmass != 0.]
+        tables.append(table)
+    return tables
+
+
+def clear_query_cache(cache_dir=None):
+    '''Remove all cached archive queries'''
+    pncache = _query_cache_path(cache_dir)
+    if pncache is not None and os.path.exists(pncache):
+        os.remove(pncache)
+
+
+def _query_cache_path(cache_dir=None):
+    '''Return the path of the query cache or None if there is no directory
+    to store it'''
+    if cache_dir is None:
+        cache_dir = default_astroquery_dir
+    if cache_dir is None:
+        return None
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    return os.path.join(cache_dir, 'eso_query_cache.sqlite')
+
+
+def _query_cache_connect(pncache):
+    con = sqlite3.connect(pncache, timeout=60)
+    con.execute('CREATE TABLE IF NOT EXISTS queries (key TEXT PRIMARY KEY, \
+querytime REAL, csv TEXT)')
+    return con
+
+
+def _read_query_cache(pncache, key, cache_ttl):
+    '''Return the cached csv output of the query or None if it is not
+    cached or older than cache_ttl days'''
+    hashkey = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    con = _query_cache_connect(pncache)
+    try:
+        row = con.execute('SELECT querytime, csv FROM queries WHERE key=?',
+                          (hashkey, )).fetchone()
+    finally:
+        con.close()
+    if row is None or (time.time() - row[0]) > cache_ttl * 86400.:
+        return None
+    return row[1]
+
+
+def _write_query_cache(pncache, key, csvtext):
+    hashkey = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    con = _query_cache_connect(pncache)
+    try:
+        with con:
+            con.execute('INSERT OR REPLACE INTO queries VALUES (?, ?, ?)',
+                        (hashkey, time.time(), csvtext))
+    finally:
+        con.close()
+
+
 def filter_calib(table, date, keep=None,
                  flat_min_exptime=.8):  # in sec
     '''This routine tries to filter the FEROS calibration data.
@@ -248,17 +605,19 @@ def filter_calib(table, date, keep=None,
     Use check_calib afterwards to see if it has worked.
     keep: 'first', 'last', 'all' ; set this keyword to keep the first
     or last 27 datasets or all'''
-    if Time(date, format='iso') < Time('2017-12-13T12:00:00.000', format='isot'):
-        new_calib = False
-    else:
-        new_calib = True
-
     table = table.sort_values('MJD-OBS').reset_index(drop=True)
+    return _window_calib(_prefilter_calib(table, date,
+                                          flat_min_exptime=flat_min_exptime),
+                         date, keep=keep, flat_min_exptime=flat_min_exptime)
+
 
+def _prefilter_calib(table, date, flat_min_exptime=.8):
+    '''First part of filter_calib which does not depend on keep. table needs
+    to be sorted by MJD-OBS'''
     if date is not None:
-        table = table.iloc[np.where([date in idate.iso for idate in
-                                     Time(table['MJD-OBS'],
-                                          format='mjd')])[0]]
+        # keep the files taken on the date
+        day = np.floor(Time(date, format='iso').mjd)
+        table = table[np.floor(np.asarray(table['MJD-OBS'], dtype=float)) == day]
     table = table[(table.Type == 'BIAS') |
                   (table.Type == 'WAVE') |
                   ((table.Type == 'FLAT') &
@@ -271,6 +630,16 @@ def filter_calib(table, date, keep=None,
     table = table.reset_index(drop=True)
     table = table.drop(table[(table.Type == 'FLAT') &
                              ~(table.Exptime >= flat_min_exptime)].index)
+    return table
+
+
+def _window_calib(table, date, keep=None, flat_min_exptime=.8):
+    '''Second part of filter_calib: select the first or last calibration
+    sequence of the prefiltered table'''
+    if Time(date, format='iso').mjd < new_calib_mjd:
+        new_calib = False
+    else:
+        new_calib = True
 
     # if all waves are taken in a row, keep the last of them
     # first find the longest consecutive waves
@@ -287,6 +656,7 @@ def filter_calib(table, date, keep=None,
         elif keep == 'all':
             pass
     # now remove the other waves
+    waveidz = set(waveidz)
     remidz = [ri for ri in table[table.Type=='WAVE'].index if ri not in waveidz]
     table = table.drop(remidz)
     table = table.reset_index(drop=True)
@@ -318,31 +688,113 @@ def filter_calib(table, date, keep=None,
 
 
 def check_calib(table, flat_min_exptime=.8):
-    if ((len(table[table.Type == 'BIAS']) == 5) &
-        (len(table[(table.Type == 'FLAT') & (table.Exptime >= flat_min_exptime)]) == 10) &
-            ((len(table[table.Type == 'WAVE']) in np.hstack(((6, 12), np.arange(21, 45)))))):
+    if len(calib_problems(table, flat_min_exptime=flat_min_exptime)) == 0:
         return True
     else:
         return False
 
 
+def calib_problems(table, flat_min_exptime=.8):
+    '''Return why the calibration files in table are not a complete
+    calibration set as list of strings. Empty if they are fine.'''
+    types = np.asarray(table.Type)
+    nbias = np.sum(types == 'BIAS')
+    nflat = np.sum((types == 'FLAT') &
+                   (np.asarray(table.Exptime, dtype=float) >= flat_min_exptime))
+    nwave = np.sum(types == 'WAVE')
+    problems = []
+    if nbias != 5:
+        problems.append('{} BIAS instead of 5'.format(nbias))
+    if nflat != 10:
+        problems.append('{} FLAT instead of 10'.format(nflat))
+    if nwave not in np.hstack(((6, 12), np.arange(21, 45))):
+        problems.append('{} WAVE instead of 6, 12 or 21-44'.format(nwave))
+    return problems
+
+
+def select_calib(t_query, night, flat_min_exptime=.8):
+    '''Select the calibration files of the night from t_query, which needs to
+    cover the night and the following day. The candidates (last/first sequence
+    of the night, then first/last of the next day) are evaluated once each and
+    the first complete one is returned. Returns the selected table (None if
+    none was complete) and a list of dicts with the date, keep, number of files
+    and the problems of each candidate.'''
+    date, edate = _calib_dates(night)
+    t_query = t_query.sort_values('MJD-OBS').reset_index(drop=True)
+    # prefilter each day only once for both candidates
+    prefiltered = {}
+    for day in [date, edate]:
+        prefiltered[day] = _prefilter_calib(t_query, day,
+                                            flat_min_exptime=flat_min_exptime)
+    diagnostics = []
+    for day, keep in [(date, 'last'), (date, 'first'),
+                      (edate, 'first'), (edate, 'last')]:
+        t_candidate = _window_calib(prefiltered[day], day, keep=keep,
+                                    flat_min_exptime=flat_min_exptime)
+        problems = calib_problems(t_candidate,
+                                  flat_min_exptime=flat_min_exptime)
+        diagnostics.append({'date': day, 'keep': keep, 'nfiles': len(t_candidate),
+                            'problems': problems})
+        if len(problems) == 0:
+            return t_candidate, diagnostics
+    return None, diagnostics
+
+
 def download_id(ids, eso_user, astroquery_dir=None,
-                store_pwd=False):
+                store_pwd=False, nworkers=None, chunksize=20,
+                max_retries=5, backoff=10., on_retrieved=None,
+                max_scratch_bytes=None):
+    '''Download the ids from the ESO archive into the astroquery cache. The
+    downloads are split into chunks of chunksize files which are retrieved in
+    parallel by nworkers threads sharing the same authenticated session.
+    Ids which have been downloaded successfully are stored in
+    download_manifest.txt in the cache, so an interrupted run continues
+    where it stopped.
+    nworkers=None
+    number of parallel downloads. Uses default_download_workers if None
+    max_retries=5, backoff=10.
+    files which are still missing after a retrieval are tried again up
+    to max_retries times, waiting backoff*2**attempt seconds in between
+    on_retrieved=None
+    function called with the list of retrieved ids as soon as a chunk is done.
+    The ids which are in the cache already are passed to it in chunks before
+    the download starts
+    max_scratch_bytes=None
+    dont start new chunks while the files retrieved in this run (and those
+    being retrieved) which are still in the cache are larger than this (unless
+    nothing is running). Use on_retrieved to free the space.'''
+    if nworkers is None:
+        nworkers = default_download_workers
     if not "eso" in locals():
         eso = Eso()
     if astroquery_dir is not None:
         eso.cache_location = astroquery_dir
-    
-    # find ids which were already downloaded
+    pnmanifest = os.path.join(eso.cache_location, 'download_manifest.txt')
+    if os.path.exists(pnmanifest):
+        with open(pnmanifest, 'r') as fmanifest:
+            manifest = set([line.strip() for line in fmanifest])
+    else:
+        manifest = set()
+
+    # find ids which were already downloaded. Uncompressed files only
+    # count if they are in the manifest, otherwise they may be incomplete
     len_before = len(ids)
-    archivefiles = os.listdir(eso.cache_location)
-    ids = [idd for idd in ids if idd+'.fits.Z' not in archivefiles]
+    archivefiles = set(os.listdir(eso.cache_location))
+    cached = [idd for idd in ids if
+              (idd+'.fits.Z' in archivefiles and _valid_download(
+                  os.path.join(eso.cache_location, idd+'.fits.Z'))) or
+              (idd in manifest and idd+'.fits' in archivefiles)]
+    ids = [idd for idd in ids if idd not in set(cached)]
     print('Of the {} ids requested, {} are already in cache'.format(
         len_before, len_before-len(ids)))
+    if on_retrieved is not None:
+        # they need to be processed (and evicted) as well, before they fill
+        # up the scratch space
+        for ii in range(0, len(cached), chunksize):
+            on_retrieved(cached[ii:ii + chunksize])
     # make sure ids is a list to not confuse eso and make it not too long
-    maxlength = 500
     ids = [ii for ii in ids]
-    ids = [ids[ii:ii + maxlength] for ii in range(0, len(ids), maxlength)]
+    chunks = [ids[ii:ii + chunksize] for ii in range(0, len(ids), chunksize)]
 
     logged_in = eso.authenticated()
     login_attempt = 0
@@ -355,69 +807,232 @@ def download_id(ids, eso_user, astroquery_dir=None,
         logged_in = eso.authenticated()
         login_attempt += 1
 
-    for iid in ids:
-        iid = iid
-        print('ESO is getting the archive files ({} files) . \
-This may take some time! Be patient ;) It might have been \
-split up into smaller chunks.'.format(len(iid)))
-        try:
-            eso.retrieve_data(iid)
-        except:
-            print('An error during downloading occured. Waiting 30s and trying again')
-            time.sleep(30)
-            eso.retrieve_data(iid)
+    print('ESO is getting the archive files ({} files in {} chunks with {} \
+parallel downloads). This may take some time! Be patient ;)'.format(
+        len(ids), len(chunks), nworkers))
+    ndone = 0
+    # ids retrieved in this run which are still in the cache
+    kept = []
+    with ThreadPoolExecutor(max_workers=nworkers) as pool:
+        running = {}
+        ichunk = 0
+        while ichunk < len(chunks) or len(running) > 0:
+            while ichunk < len(chunks) and len(running) < nworkers and (
+                    max_scratch_bytes is None or len(running) == 0 or
+                    _scratch_size(eso.cache_location, kept + [
+                        iid for chunk in running.values() for iid in chunk])
+                    < max_scratch_bytes):
+                running[pool.submit(_retrieve_chunk, eso, chunks[ichunk],
+                                    pnmanifest, max_retries, backoff)] = \
+                    chunks[ichunk]
+                ichunk += 1
+            done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                retrieved = future.result()
+                ndone += len(retrieved)
+                if on_retrieved is not None and len(retrieved) > 0:
+                    on_retrieved(retrieved)
+                kept += retrieved
+            if max_scratch_bytes is not None:
+                kept = [iid for iid in kept if
+                        _scratch_size(eso.cache_location, [iid]) > 0]
+    print('Retrieved {} of {} files'.format(ndone, len(ids)))
     return eso.cache_location
 
-def get_calib(night, flat_min_exptime=.8, unrobust_calibfiles=True):
+
+def _scratch_size(cache_dir, ids):
+    '''Size of the fits files of ids in the cache in bytes'''
+    return sum([os.path.getsize(pn) for iid in ids
+                for pn in [os.path.join(cache_dir, iid+'.fits'),
+                           os.path.join(cache_dir, iid+'.fits.Z')]
+                if os.path.isfile(pn)])
+
+
+def _retrieve_chunk(eso, chunk, pnmanifest, max_retries=5, backoff=10.):
+    '''Retrieve the ids in chunk, retrying the missing ones with exponential
+    backoff. Only ids whose files are complete (see _valid_download) are added
+    to the manifest file. Returns the retrieved ids.'''
+    missing = list(chunk)
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            print('{} files missing. Waiting {}s and trying again'.format(
+                len(missing), backoff * 2**(attempt - 1)))
+            time.sleep(backoff * 2**(attempt - 1))
+        failed = False
+        try:
+            eso.retrieve_data(missing)
+        except Exception as error:
+            print('An error during downloading occured: {}'.format(error))
+            failed = True
+        retrieved = []
+        for idd in missing:
+            for ending in ['.fits', '.fits.Z']:
+                pncache = os.path.join(eso.cache_location, idd+ending)
+                if not os.path.isfile(pncache):
+                    continue
+                # after an error the files may be cut off. Test them properly
+                if _valid_download(pncache, thorough=failed):
+                    retrieved.append(idd)
+                else:
+                    print('Removing the incomplete download {}'.format(pncache))
+                    os.remove(pncache)
+                break
+        _update_manifest(pnmanifest, add=retrieved)
+        missing = [idd for idd in missing if idd not in retrieved]
+        if len(missing) == 0:
+            break
+    return [idd for idd in chunk if idd not in missing]
+
+
+def _valid_download(pnfile, thorough=False):
+    '''Check that a downloaded file is complete. fits files have to consist
+    of full 2880 byte blocks, .Z files need the compress magic number. With
+    thorough=True the .Z files are also test-decompressed'''
+    try:
+        size = os.path.getsize(pnfile)
+    except OSError:
+        return False
+    if size == 0:
+        return False
+    if pnfile.endswith('.fits'):
+        return size % 2880 == 0
+    with open(pnfile, 'rb') as fin:
+        if fin.read(2) != b'\x1f\x9d':
+            return False
+    if thorough:
+        return call(['gzip', '-t', pnfile]) == 0
+    return True
+
+
+def _update_manifest(pnmanifest, add=(), remove=()):
+    '''Add and remove ids from the download manifest. The manifest is locked
+    against other threads and processes (also on other nodes) sharing the
+    cache, written to a temporary file first and then replaces the old one'''
+    if len(add) == 0 and len(remove) == 0:
+        return
+    with locked(pnmanifest):
+        manifest = []
+        if os.path.exists(pnmanifest):
+            with open(pnmanifest, 'r') as fmanifest:
+                manifest = [line.strip() for line in fmanifest if line.strip() != '']
+        manifest = [idd for idd in dict.fromkeys(manifest + list(add))
+                    if idd not in remove]
+        pntmp = tmp_name(pnmanifest)
+        with open(pntmp, 'w') as fmanifest:
+            fmanifest.write(''.join([idd+'\n' for idd in manifest]))
+        os.replace(pntmp, pnmanifest)
+
+
+def get_calib(night, flat_min_exptime=.8, unrobust_calibfiles=True,
+              refresh=False):
+    '''Query and select the calibration files of a single night. Use
+    get_calib_nights if you need the calibration of several nights, as it
+    needs much fewer queries.'''
     # convert Time to strings for query
-    edate = Time(night.jd + 1, format='jd').iso[:10]
-    date = night.iso[:10]
+    date, edate = _calib_dates(night)
 
     t_query = query_eso("", category="CALIB",
                         sdate=date, starttime="00",
-                        edate=edate, endtime="24")
+                        edate=edate, endtime="24", refresh=refresh)
     # remove non-technical time
     t_query = t_query[t_query.Program_ID.str.startswith('60.A-')]
 
-    # try the first half of the night
+    return _select_calib(t_query, night, flat_min_exptime=flat_min_exptime,
+                         unrobust_calibfiles=unrobust_calibfiles)
+
+
+def get_calib_nights(nights, flat_min_exptime=.8, unrobust_calibfiles=True,
+                     max_gap_days=30, max_span_days=365, refresh=False,
+                     cache_dir=None):
+    '''Same as get_calib, but for many nights at once. Instead of querying
+    the archive for each night, the nights are grouped into date ranges and
+    only one CALIB query is done per range. The result is then split by night
+    and the selection is done as in get_calib.
+    max_gap_days=30
+    start a new query if two consecutive nights are further apart than this
+    max_span_days=365
+    maximum number of days covered by a single query
+    refresh=False, cache_dir=None
+    passed to query_eso
+    Returns a list of (down_ids, check_manually), one entry per night in the
+    order of nights.'''
+    results = [None, ] * len(nights)
+    groups = _group_nights(nights, max_gap_days=max_gap_days,
+                           max_span_days=max_span_days)
+    queries = []
+    for group in groups:
+        sdate = _calib_dates(nights[group[0]])[0]
+        edate = _calib_dates(nights[group[-1]])[1]
+        print('Querying calibration files of {} nights between {} and {}'.format(
+            len(group), sdate, edate))
+        queries.append({'target': "", 'category': "CALIB",
+                        'sdate': sdate, 'starttime': "00",
+                        'edate': edate, 'endtime': "24"})
+    # all ranges at the same time
+    t_queries = query_eso_many(queries, refresh=refresh, cache_dir=cache_dir)
+    for group, t_query in zip(groups, t_queries):
+        # remove non-technical time
+        t_query = t_query[t_query.Program_ID.str.startswith('60.A-')]
+        mjds = np.asarray(t_query['MJD-OBS'], dtype=float)
+        for inight in group:
+            # same range as the single night query: date 00h to edate 24h
+            day = np.floor(nights[inight].mjd)
+            t_night = t_query[(mjds >= day) & (mjds < day + 2)]
+            results[inight] = _select_calib(
+                t_night, nights[inight],
+                flat_min_exptime=flat_min_exptime,
+                unrobust_calibfiles=unrobust_calibfiles)
+    return results
+
+
+def _calib_dates(night):
+    '''Return the date of the night and the following one as yyyy-mm-dd'''
+    edate = Time(night.jd + 1, format='jd').iso[:10]
+    date = night.iso[:10]
+    return date, edate
+
+
+def _group_nights(nights, max_gap_days=30, max_span_days=365):
+    '''Group the indices of nights into ranges which can be covered by a single
+    query. Returns a list of lists of indices, sorted by date.'''
+    groups = []
+    for inight in sorted(range(len(nights)), key=lambda ii: nights[ii].mjd):
+        mjd = nights[inight].mjd
+        if len(groups) > 0 and \
+           (mjd - nights[groups[-1][-1]].mjd) <= max_gap_days and \
+           (mjd - nights[groups[-1][0]].mjd) <= max_span_days:
+            groups[-1].append(inight)
+        else:
+            groups.append([inight, ])
+    return groups
+
+
+def _select_calib(t_query, night, flat_min_exptime=.8, unrobust_calibfiles=True):
+    '''Select the calibration files of the night from the query result t_query
+    which needs to cover the night and the following day.'''
+    date, edate = _calib_dates(night)
+
     calib_failed = True
     if len(t_query) > 0:
         # try first half of the night, then second
-        if check_calib(filter_calib(t_query, date=date, keep='last',
-                                    flat_min_exptime=flat_min_exptime),
-                                    flat_min_exptime=flat_min_exptime):
-            t_query2 = filter_calib(t_query, date=date, keep='last',
-                                    flat_min_exptime=flat_min_exptime)
-            calib_failed = False
-        elif check_calib(filter_calib(t_query, date=date, keep='first',
-                                    flat_min_exptime=flat_min_exptime),
-                                    flat_min_exptime=flat_min_exptime):
-            t_query2 = filter_calib(t_query, date=date, keep='first',
-                                    flat_min_exptime=flat_min_exptime)
-            calib_failed = False
-        elif check_calib(filter_calib(t_query, date=edate, keep='first',
-                                    flat_min_exptime=flat_min_exptime),
-                                    flat_min_exptime=flat_min_exptime):
-            t_query2 = filter_calib(t_query, date=edate, keep='first',
-                                    flat_min_exptime=flat_min_exptime)
+        t_query2, diagnostics = select_calib(t_query, night,
+                                             flat_min_exptime=flat_min_exptime)
+        if t_query2 is not None:
             calib_failed = False
-        elif check_calib(filter_calib(t_query, date=edate, keep='last',
-                                    flat_min_exptime=flat_min_exptime),
-                                    flat_min_exptime=flat_min_exptime):
-            t_query2 = filter_calib(t_query, date=edate, keep='last',
-                                    flat_min_exptime=flat_min_exptime)
-            calib_failed = False
-
-        if not calib_failed:
             down_ids = t_query2['Dataset ID'].tolist()
+        else:
+            for diagnostic in diagnostics:
+                print('Rejected {keep} calibration of {date} ({nfiles} files): \
+{problems}'.format(**diagnostic))
     if calib_failed:
         down_ids = []
         print('Cant find calib files automatically for date ', date)
         check_manually = [date, ]
         if unrobust_calibfiles:
             print('Downloading all calibfiles as requested')
-            down_ids=filter_calib(t_query, date=date, keep='all',
-                                  flat_min_exptime=0.)
+            down_ids = filter_calib(t_query, date=date, keep='all',
+                                    flat_min_exptime=0.)['Dataset ID'].tolist()
 
     else:
         check_manually = []
@@ -428,30 +1043,48 @@ def get_calib(night, flat_min_exptime=.8, unrobust_calibfiles=True):
 def distribute_files(id_list, id2nights,
                      src_dir,
                      calib_dir, science_dir,
-                     science_ids=[], fileending='.fits.Z'):
+                     science_ids=[], fileending='.fits.Z',
+                     link_mode=None, dry_run=False):
     '''Distribute the downloaded files to the output folder. If you provide
     the science ids, the science files will be copied in
-    a different folder than the calib files.'''
+    a different folder than the calib files.
+    link_mode=None
+    'hardlink', 'reflink' or 'copy'. Links are only possible on the same
+    filesystem, otherwise the files are copied. Uses default_link_mode if None
+    dry_run=False
+    set to True to only report how many files and bytes would be distributed
+    and how much space linking saves'''
+    if link_mode is None:
+        link_mode = default_link_mode
     missing_files = []
     science_files = []
-    outdir = {'calibfile': calib_dir,
-              'sciencefile': science_dir}
+    nlinked = 0
+    ncopied = 0
+    saved_bytes = 0
     for iid in id_list:
         fpath = os.path.join(src_dir, iid + fileending)
         if iid in science_ids:
             filetype = 'sciencefile'
-            pnouts = [os.path.join(outdir[filetype], tnight.iso[:10].replace("-", ""),
-                                   iid+fileending) for tnight in id2nights[iid]]
         else:
             filetype = 'calibfile'
-            pnouts = [os.path.join(outdir[filetype], tnight.iso[:10].replace("-", ""),
-                                 iid+fileending) for tnight in id2nights[iid]]
+        pnouts = _destinations(iid, id2nights, calib_dir, science_dir,
+                               science_ids=science_ids, fileending=fileending)
         for pnout in pnouts:
             if not (os.path.isfile(pnout) or os.path.isfile(pnout[:-2])):
                 if filetype == 'sciencefile':
                     science_files.append(pnout.replace(".fits.Z", ".fits"))
                 try:
-                    copyfile(fpath, pnout)
+                    fsize = os.path.getsize(fpath)
+                    if dry_run:
+                        linked = link_mode != 'copy' and _same_filesystem(
+                            fpath, os.path.dirname(pnout))
+                    else:
+                        linked = _place_file(fpath, pnout, link_mode)
+                    if linked:
+                        nlinked += 1
+                        saved_bytes += fsize
+                    else:
+                        ncopied += 1
                 except IOError:
                     if filetype == 'sciencefile':
                         print('Somehow {} {} is missing (protected file?) - or {} cannot be \
@@ -460,51 +1093,224 @@ written. Trying downloading it later again.'.format(filetype, fpath, pnout))
                     else:
                         warn('{} {} could not be downloaded. Even though it is not a \
 potentially protected sciencefile')
+    print('{}{} files linked ({}), {} files copied. Saved {:.2f} GB'.format(
+        'DRY RUN: ' if dry_run else '', nlinked, link_mode, ncopied,
+        saved_bytes / 1e9))
     return missing_files, science_files
 
 
+def _place_file(src, dst, link_mode='hardlink'):
+    '''Hardlink or reflink src to dst. Copy it if this is not possible, e.g.
+    because they are on different filesystems. Returns True if it was linked.'''
+    if link_mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return True
+        except OSError as error:
+            if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK,
+                                   errno.ENOTSUP):
+                raise
+    elif link_mode == 'reflink':
+        with open(src, 'rb') as fsrc:
+            with open(dst, 'wb') as fdst:
+                try:
+                    # FICLONE ioctl of linux (btrfs, xfs,...)
+                    fcntl.ioctl(fdst.fileno(), 0x40049409, fsrc.fileno())
+                    linked = True
+                except OSError:
+                    linked = False
+        if linked:
+            shutil.copystat(src, dst)
+            return True
+    copyfile(src, dst)
+    return False
+
+
+def _same_filesystem(src, dst_dir):
+    if not os.path.exists(src) or not os.path.exists(dst_dir):
+        raise IOError('{} or {} does not exist'.format(src, dst_dir))
+    return os.stat(src).st_dev == os.stat(dst_dir).st_dev
+
 
-def compress_files(direct, fileending='.fits'):
+def compress_files(direct, fileending='.fits', codec='Z', nworkers=None,
+                   filelist=None, pool=None):
     '''Compress the files having the fileending "fileending=.fits". This is necessary
     as newer eso version automatically uncompresses compressed .fits.Z files. Recompressing
     saves space and handling easier, as it is independent of the version. Ignoring
-    files which are compressed already.'''
-    filelist = [ff for ff in os.listdir(direct) if np.logical_and(
-        ff.endswith(fileending), not os.path.isfile(ff+'.Z'))]
+    files which are compressed already.
+    codec='Z'
+    'Z' for LZW compression (.Z) or 'gz' for gzip (.gz)
+    nworkers=None
+    number of processes to use. Uses all cpus if None
+    filelist=None
+    compress only these files (if they exist) instead of all in direct
+    pool=None
+    process pool to use, e.g. from _codec_pool. A new one is made if None'''
+    ext = _codec_ext[codec]
+    if filelist is None:
+        filelist = [os.path.join(direct, ff) for ff in os.listdir(direct)]
+    filelist = [ff for ff in filelist if np.logical_and(
+        ff.endswith(fileending) and os.path.isfile(ff),
+        not os.path.isfile(ff+ext))]
     print('Compressing the {} files in {}'.format(len(filelist), direct))
-    for ffile in filelist:
-        call(["compress", os.path.join(direct, ffile)])
+    _run_codec(_compress_one, [(ffile, codec) for ffile in filelist],
+               nworkers=nworkers, action='Compressed', pool=pool)
 
 
-def extract_files(direct, overwrite_old="ask"):
-    '''decompressing all .fits.Z files in the directory+subdirectories'''
+def extract_files(direct, overwrite_old="ask", nworkers=None,
+                  keep_compressed=False, filelist=None, pool=None):
+    '''decompressing all .fits.Z (and .fits.gz) files in the directory+subdirectories.
+    Files which have already been extracted and are not older than the
+    compressed file are skipped.
+    keep_compressed=False
+    set to True to keep the compressed files next to the extracted ones. Then
+    they are not extracted again in the next run
+    filelist=None
+    extract only these files instead of all in direct
+    nworkers=None
+    number of processes to use. Uses all cpus if None
+    pool=None
+    process pool to use, e.g. from _codec_pool. A new one is made if None'''
     # filelist = [yy for x in os.walk(direct)
     #             for yy in glob(os.path.join(x[0], '*.fits.Z'))]
-    filelist = []
-    for root, dirs, files in os.walk(direct):
-        for ff in files:
-            if ff.endswith('.fits.Z'):
-                filelist.append(os.path.join(root, ff))
+    if filelist is None:
+        filelist = []
+        for root, dirs, files in os.walk(direct):
+            for ff in files:
+                if ff.endswith('.fits.Z') or ff.endswith('.fits.gz'):
+                    filelist.append(os.path.join(root, ff))
 
     print('Uncompressing the {} files in {}'.format(len(filelist), direct))
+    todo = []
+    nuptodate = 0
     for ifile in filelist:
+        ofile = _extracted_name(ifile)
         # if the target file does exist, ask
-        if os.path.isfile(ifile[:-2]):
+        if os.path.isfile(ofile):
+            if _is_up_to_date(ifile, ofile):
+                nuptodate += 1
+                if not keep_compressed:
+                    os.remove(ifile)
+                continue
             if overwrite_old not in [True, False]:
                 overwrite_old = input(
-                    "File %s does exist. Overwrite all existing files? Type 'y' or get asked for each file:" % (ifile[:-2]))
+                    "File %s does exist. Overwrite all existing files? Type 'y' or get asked for each file:" % (ofile))
                 if overwrite_old in ['y', 'Y', 'j', 'J', 't', 'T', 'True', True]:
                     overwrite_old = True
                 else:
                     overwrite_old = 'ask'
             if overwrite_old:
-                os.remove(ifile[:-2])
+                os.remove(ofile)
             if not overwrite_old:
                 continue
-        call(["uncompress", ifile])
+        todo.append((ifile, keep_compressed))
+    if nuptodate > 0:
+        print('Skipped {} files which were extracted already'.format(nuptodate))
+    _run_codec(_extract_one, todo, nworkers=nworkers, action='Uncompressed',
+               pool=pool)
     return overwrite_old
 
 
+_codec_ext = {'Z': '.Z', 'gz': '.gz'}
+
+
+def _extracted_name(pnin):
+    for ext in _codec_ext.values():
+        if pnin.endswith(ext):
+            return pnin[:-len(ext)]
+    return pnin
+
+
+def _is_up_to_date(pnin, pnout):
+    '''The extracted file is up to date, if it is not empty and not older than
+    the compressed one (the extraction keeps the time of the compressed file)'''
+    return os.path.getsize(pnout) > 0 and \
+        os.path.getmtime(pnout) >= os.path.getmtime(pnin)
+
+
+def _run_codec(func, args, nworkers=None, action='Processed', pool=None):
+    '''Run func on all args on a process pool (pool if given) and print the
+    throughput. func needs to return the number of uncompressed bytes
+    processed.'''
+    if len(args) == 0:
+        return
+    tstart = time.time()
+    nbytes = 0
+    if pool is not None:
+        futures = [pool.submit(func, *arg) for arg in args]
+        for future in as_completed(futures):
+            nbytes += future.result()
+    elif nworkers == 1:
+        for arg in args:
+            nbytes += func(*arg)
+    else:
+        with ProcessPoolExecutor(max_workers=nworkers) as pool:
+            futures = [pool.submit(func, *arg) for arg in args]
+            for future in as_completed(futures):
+                nbytes += future.result()
+    dtime = max(time.time() - tstart, 1e-6)
+    print('{} {} files ({:.1f} MB) in {:.1f}s: {:.1f} files/s, {:.1f} MB/s'.format(
+        action, len(args), nbytes / 1e6, dtime, len(args) / dtime,
+        nbytes / 1e6 / dtime))
+
+
+def _codec_pool(nworkers=None):
+    '''A process pool for compress_files and extract_files which can be used
+    while other threads run (e.g. downloads), see misc.process_pool'''
+    return process_pool(nworkers)
+
+
+def _compress_one(pnin, codec='Z'):
+    '''Compress a single file, replacing it by the compressed one. Returns the
+    size of the uncompressed file'''
+    nbytes = os.path.getsize(pnin)
+    pnout = pnin + _codec_ext[codec]
+    if codec == 'Z' and ncompress is None:
+        call(["compress", pnin])
+        return nbytes
+    pntmp = pnout + '.tmp'
+    with open(pnin, 'rb') as fin:
+        if codec == 'gz':
+            with gzip.open(pntmp, 'wb') as fout:
+                shutil.copyfileobj(fin, fout)
+        else:
+            with open(pntmp, 'wb') as fout:
+                ncompress.compress(fin, fout)
+    shutil.copystat(pnin, pntmp)
+    os.replace(pntmp, pnout)
+    os.remove(pnin)
+    return nbytes
+
+
+def _extract_one(pnin, keep_compressed=False):
+    '''Extract a single .Z or .gz file. The extracted file gets the
+    modification time of the compressed one. Returns the size of the
+    extracted file. If the extraction fails, the compressed file is kept
+    and 0 is returned'''
+    pnout = _extracted_name(pnin)
+    pntmp = pnout + '.tmp'
+    try:
+        with open(pntmp, 'wb') as fout:
+            if pnin.endswith('.gz'):
+                with gzip.open(pnin, 'rb') as fin:
+                    shutil.copyfileobj(fin, fout)
+            elif ncompress is not None:
+                with open(pnin, 'rb') as fin:
+                    ncompress.decompress(fin, fout)
+            else:
+                check_call(["uncompress", "-c", pnin], stdout=fout)
+    except Exception as error:
+        print('Couldnt extract {} ({}). Keeping it'.format(pnin, error))
+        if os.path.exists(pntmp):
+            os.remove(pntmp)
+        return 0
+    shutil.copystat(pnin, pntmp)
+    os.replace(pntmp, pnout)
+    if not keep_compressed:
+        os.remove(pnin)
+    return os.path.getsize(pnout)
+
+
 def longest_sequence_idz(array, key):
     '''Return the indices of the longest reoccuring time of key. E.g.
     key = 0:
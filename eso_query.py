@@ -0,0 +1,115 @@
+import io
+import asyncio
+import threading
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from config import default_eso_query_url
+
+# columns of an empty query result
+empty_columns = ['OBJECT', 'RA', 'DEC',
+                 'Program_ID', 'Instrument',
+                 'Category', 'Type', 'Mode',
+                 'Dataset ID', 'Release_Date',
+                 'TPL ID', 'TPL START',
+                 'Exptime', 'Filter',
+                 'MJD-OBS', 'Airmass']
+
+
+def query_params(target, instrument='FEROS', category='SCIENCE',
+                 sdate="", edate="", starttime="12", endtime="12",
+                 maxrows=999999, query_radius="08+00"):
+    '''The parameters of the archive query form as dict'''
+    return {'tab_object': 'on', 'target': target, 'resolver': 'simbad',
+            'tab_target_coord': 'on', 'ra': '', 'dec': '',
+            'box': '00 ' + query_radius.replace('+', ' '),
+            'deg_or_hour': 'hours', 'format': 'SexaHours',
+            'tab_prog_id': 'on', 'prog_id': '',
+            'tab_instrument': 'on', 'instrument': instrument,
+            'stime': sdate, 'starttime': starttime,
+            'etime': edate, 'endtime': endtime,
+            'tab_dp_cat': 'true', 'dp_cat': category,
+            'top': str(maxrows), 'wdbo': 'csv'}
+
+
+def fetch_csvs(params_list, concurrency=4, timeout=300., max_retries=3,
+               backoff=5., url=None):
+    '''Run the queries in params_list (dicts from query_params) concurrently
+    and return their csv output in the same order. Failed queries are retried
+    max_retries times, waiting backoff*2**attempt seconds in between. If a
+    query still fails, its entry is the exception instead of the text.
+    url=None
+    url of the query form. Uses default_eso_query_url if None'''
+    if url is None:
+        url = default_eso_query_url
+    coro = _fetch_all(params_list, url, concurrency=concurrency,
+                      timeout=timeout, max_retries=max_retries,
+                      backoff=backoff)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    # there is a running loop already (e.g. jupyter). Use an own thread
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(
+        csvs=asyncio.run(coro)))
+    thread.start()
+    thread.join()
+    return result['csvs']
+
+
+def parse_csv(csvtext):
+    '''Parse the csv output of a query into a DataFrame. Returns an empty one
+    with the usual columns if there is no result.'''
+    try:
+        return pd.read_csv(io.StringIO(csvtext), comment='#', sep=',',
+                           skip_blank_lines=True)
+    except Exception:
+        return pd.DataFrame(columns=empty_columns)
+
+
+def valid_csv(csvtext):
+    '''Whether csvtext is the csv output of a query (possibly without rows)
+    and not e.g. an error page of the archive'''
+    lines = [line for line in csvtext.splitlines()
+             if line.strip() != '' and not line.startswith('#')]
+    if len(lines) == 0:
+        return True
+    return 'Dataset ID' in [col.strip().strip('"') for col in lines[0].split(',')]
+
+
+async def _fetch_all(params_list, url, concurrency=4, timeout=300.,
+                     max_retries=3, backoff=5.):
+    # one session, so the connections are reused
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    semaphore = asyncio.Semaphore(concurrency)
+    try:
+        return await asyncio.gather(*[
+            _fetch(session, url, params, semaphore, timeout=timeout,
+                   max_retries=max_retries, backoff=backoff)
+            for params in params_list], return_exceptions=True)
+    finally:
+        session.close()
+
+
+async def _fetch(session, url, params, semaphore, timeout=300., max_retries=3,
+                 backoff=5.):
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        for attempt in range(max_retries + 1):
+            try:
+                # requests blocks, so run it in a thread of the loop
+                response = await loop.run_in_executor(
+                    None, lambda: session.get(url, params=params,
+                                              timeout=timeout))
+                response.raise_for_status()
+                return response.text
+            except requests.RequestException as error:
+                if attempt == max_retries:
+                    raise
+                print('Query failed ({}). Trying again in {}s'.format(
+                    error, backoff * 2**attempt))
+                await asyncio.sleep(backoff * 2**attempt)
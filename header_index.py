@@ -0,0 +1,110 @@
+import os
+import sqlite3
+from astropy.io import fits
+from config import default_log_dir
+from misc import process_pool
+
+# the header keywords stored in the index and their column names
+keywords = {'catg': 'ESO DPR CATG',
+            'type': 'ESO DPR TYPE',
+            'object': 'OBJECT',
+            'mjd': 'MJD-OBS',
+            'ra': 'RA',
+            'dec': 'DEC',
+            'exptime': 'EXPTIME'}
+# reading less files than this is done without a process pool
+min_files_parallel = 50
+
+
+def get_headers(paths, pnindex=None, nworkers=None):
+    '''Return the indexed header keywords of the fits files in paths as a dict
+    of the absolute path and a dict of the keywords (see keywords, missing ones
+    are None). The headers are stored in an sqlite file, keyed by path,
+    modification time and size. Only new or changed files are read, in
+    parallel by nworkers processes. Files which cant be read are reported and
+    missing in the result.
+    pnindex=None
+    path of the index. Uses header_index.sqlite in the default_log_dir if None'''
+    paths = [os.path.abspath(pn) for pn in paths]
+    con = _connect(pnindex)
+    try:
+        indexed = {}
+        for ii in range(0, len(paths), 500):
+            chunk = paths[ii:ii+500]
+            rows = con.execute('SELECT * FROM headers WHERE path IN ({})'.format(
+                ','.join(['?', ] * len(chunk))), chunk).fetchall()
+            for row in rows:
+                indexed[row[0]] = row
+        headers = {}
+        todo = []
+        for pn in paths:
+            try:
+                stat = os.stat(pn)
+            except OSError as error:
+                print('Skipping {} ({})'.format(pn, error))
+                continue
+            row = indexed.get(pn)
+            if row is not None and row[1] == stat.st_mtime and \
+               row[2] == stat.st_size:
+                headers[pn] = dict(zip(keywords.keys(), row[3:]))
+            else:
+                todo.append((pn, stat.st_mtime, stat.st_size))
+        if len(todo) > 0:
+            print('Reading {} new or changed headers'.format(len(todo)))
+            if len(todo) < min_files_parallel or nworkers == 1:
+                values = [_read_header(pn) for pn, mtime, size in todo]
+            else:
+                with process_pool(nworkers) as pool:
+                    values = list(pool.map(_read_header,
+                                           [pn for pn, mtime, size in todo],
+                                           chunksize=20))
+            read = [(job, value) for job, value in zip(todo, values)
+                    if value is not None]
+            with con:
+                con.executemany(
+                    'INSERT OR REPLACE INTO headers VALUES ({})'.format(
+                        ','.join(['?', ] * (3 + len(keywords)))),
+                    [[pn, mtime, size] + [value[key] for key in keywords.keys()]
+                     for (pn, mtime, size), value in read])
+            for (pn, mtime, size), value in read:
+                headers[pn] = value
+    finally:
+        con.close()
+    return headers
+
+
+def update_index(direct, pnindex=None, nworkers=None):
+    '''Add all new or changed fits files in direct and its subdirectories to
+    the index. The products of the reduction (folders ending on _red or proc)
+    are left out, as in all_subfolders'''
+    ffiles = []
+    for root, dirs, files in os.walk(direct):
+        dirs[:] = [dd for dd in dirs if not (dd.endswith('_red') or
+                                             dd.endswith('proc'))]
+        if root.endswith('_red') or root.endswith('proc'):
+            continue
+        ffiles += [os.path.join(root, ff) for ff in files if ff.endswith('.fits')]
+    return get_headers(ffiles, pnindex=pnindex, nworkers=nworkers)
+
+
+def _read_header(pn):
+    try:
+        header = fits.getheader(pn)
+    except Exception as error:
+        print('Couldnt read the header of {} ({}). Skipping it'.format(pn, error))
+        return None
+    value = {}
+    for key, keyword in keywords.items():
+        value[key] = header.get(keyword)
+        if isinstance(value[key], str):
+            value[key] = value[key].strip()
+    return value
+
+
+def _connect(pnindex=None):
+    if pnindex is None:
+        pnindex = os.path.join(default_log_dir, 'header_index.sqlite')
+    con = sqlite3.connect(pnindex, timeout=60)
+    con.execute('CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, \
+mtime REAL, size INTEGER, {})'.format(', '.join(keywords.keys())))
+    return con
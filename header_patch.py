@@ -0,0 +1,270 @@
+import os
+import csv
+import json
+import time
+import struct
+import warnings
+from concurrent.futures import as_completed
+from astropy.io import fits
+from config import default_log_dir
+from misc import process_pool
+
+# sizes of a header card and a fits block in bytes
+card_length = 80
+block_length = 2880
+# patching less files than this is done without a process pool
+min_files_parallel = 50
+# columns of the change log. old and new are json encoded, old is null for
+# keywords which were added
+log_columns = ['time', 'path', 'keyword', 'old', 'new', 'method']
+
+
+def patch_headers(changes, pnlog=None, nworkers=None):
+    '''Set keywords in the primary header of many fits files. changes is a dict
+    of the paths and dicts of the keywords and their new values. If the new
+    cards fit in the existing header (new keywords in its padding), they are
+    written to the file directly without reading the data. Otherwise astropy
+    rewrites the file in update mode. CHECKSUMs are updated.
+    Every change is appended to pnlog (header_changes.csv in the
+    default_log_dir if None) as soon as its file is patched, see undo_patches.
+    If a file cant be patched, the others are still patched and logged and
+    the first error is raised at the end. Returns the number of changed
+    keywords.
+    nworkers=None
+    number of processes patching the files. Uses all cpus if None'''
+    if pnlog is None:
+        pnlog = os.path.join(default_log_dir, 'header_changes.csv')
+    jobs = [(os.path.abspath(pn), cards) for pn, cards in changes.items()
+            if len(cards) > 0]
+    if len(jobs) == 0:
+        return 0
+    nrows = 0
+    ninplace = 0
+    errors = []
+    newlog = not os.path.exists(pnlog)
+    with open(pnlog, 'a', newline='') as flog:
+        writer = csv.writer(flog)
+        if newlog:
+            writer.writerow(log_columns)
+        # log each file as soon as it is patched, so a later error doesnt lose
+        # the changes needed by undo_patches
+        for pn, patched in _patch_files(jobs, nworkers):
+            if isinstance(patched, Exception):
+                print('Couldnt patch {} ({!r})'.format(pn, patched))
+                errors.append(patched)
+                continue
+            writer.writerows([[time.strftime('%Y-%m-%dT%H:%M:%S'), pn, keyword,
+                               json.dumps(old), json.dumps(new), method]
+                              for keyword, old, new, method in patched])
+            flog.flush()
+            nrows += len(patched)
+            ninplace += len([method for keyword, old, new, method in patched
+                             if method == 'inplace'])
+    print('Changed {} header keywords in {} files ({} in place, {} rewritten)'.format(
+        nrows, len(jobs) - len(errors), ninplace, nrows - ninplace))
+    if len(errors) > 0:
+        raise errors[0]
+    return nrows
+
+
+def undo_patches(pnlog=None, since=None, nworkers=None):
+    '''Restore the header values changed by patch_headers as logged in pnlog.
+    Keywords which were added are removed again. The restoring is logged as well.
+    since=None
+    only undo the changes made at or after this time (as in the log,
+    e.g. 2020-01-31T12:00:00). Undoes all changes if None'''
+    if pnlog is None:
+        pnlog = os.path.join(default_log_dir, 'header_changes.csv')
+    with open(pnlog, 'r', newline='') as flog:
+        rows = list(csv.DictReader(flog))
+    if since is not None:
+        rows = [row for row in rows if row['time'] >= since]
+    # the oldest value of each keyword in the range
+    changes = {}
+    for row in reversed(rows):
+        changes.setdefault(row['path'], {})[row['keyword']] = json.loads(
+            row['old'])
+    changes = dict([(pn, cards) for pn, cards in changes.items()
+                    if os.path.exists(pn)])
+    print('Restoring the headers of {} files'.format(len(changes)))
+    return patch_headers(changes, pnlog=pnlog, nworkers=nworkers)
+
+
+def _patch_files(jobs, nworkers=None):
+    '''Patch the files of jobs and yield the path and the changes (or the
+    exception) of each file as soon as it is done'''
+    if len(jobs) < min_files_parallel or nworkers == 1:
+        for job in jobs:
+            try:
+                yield job[0], _patch_file(job)
+            except Exception as error:
+                yield job[0], error
+        return
+    with process_pool(nworkers) as pool:
+        futures = dict([(pool.submit(_patch_file, job), job[0]) for job in jobs])
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as error:
+                yield futures[future], error
+
+
+def _patch_file(job):
+    '''Patch the header of one file. Returns a list of the keyword, old and new
+    value and the method used for each changed keyword'''
+    pn, cards = job
+    try:
+        patched = _patch_inplace(pn, cards)
+    except (OSError, ValueError) as error:
+        warnings.warn('Couldnt patch {} in place ({})'.format(pn, error))
+        patched = None
+    if patched is None:
+        patched = _patch_update(pn, cards)
+    return patched
+
+
+def _patch_inplace(pn, cards):
+    '''Replace the cards in the raw header bytes. Returns None if this is not
+    possible (long values, deletions or no space for new keywords)'''
+    with open(pn, 'r+b') as ff:
+        header = b''
+        iend = None
+        while iend is None:
+            block = ff.read(block_length)
+            if len(block) < block_length:
+                return None
+            header += block
+            for icard in range(len(header) // card_length - block_length //
+                               card_length, len(header) // card_length):
+                if header[icard*card_length:icard*card_length+8] == b'END     ':
+                    iend = icard
+                    break
+        positions = {}
+        for icard in range(iend):
+            keyword = _card_keyword(header[icard*card_length:
+                                           (icard+1)*card_length])
+            if keyword not in positions:
+                positions[keyword] = icard
+
+        header = bytearray(header)
+        patched = []
+        for keyword, value in cards.items():
+            if value is None:
+                return None
+            keyword = keyword.upper()
+            if keyword in positions:
+                icard = positions[keyword]
+                oldcard = fits.Card.fromstring(bytes(
+                    header[icard*card_length:(icard+1)*card_length]).decode('ascii'))
+                old = oldcard.value
+                if old == value:
+                    continue
+                comment = oldcard.comment
+            else:
+                # use the next card of the padding and move the END there
+                if iend + 1 >= len(header) // card_length:
+                    return None
+                icard = iend
+                iend += 1
+                header[iend*card_length:(iend+1)*card_length] = \
+                    b'END'.ljust(card_length)
+                positions[keyword] = icard
+                old = None
+                comment = ''
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                image = fits.Card(keyword, value, comment).image
+            if len(image) != card_length:
+                return None
+            header[icard*card_length:(icard+1)*card_length] = image.encode('ascii')
+            patched.append((keyword, old, value, 'inplace'))
+        if len(patched) == 0:
+            return patched
+        if 'CHECKSUM' in positions:
+            if 'DATASUM' not in positions:
+                return None
+            _update_checksum(header, positions['CHECKSUM'], positions['DATASUM'])
+        ff.seek(0)
+        ff.write(header)
+    return patched
+
+
+def _patch_update(pn, cards):
+    '''Patch the header with astropy, which rewrites the file if needed'''
+    patched = []
+    with fits.open(pn, mode='update') as hdul:
+        header = hdul[0].header
+        for keyword, value in cards.items():
+            old = header.get(keyword)
+            if old == value:
+                continue
+            if value is None:
+                del header[keyword]
+            else:
+                header[keyword] = value
+            patched.append((keyword, old, value, 'update'))
+        if len(patched) > 0 and 'CHECKSUM' in header:
+            hdul[0].add_checksum()
+    return patched
+
+
+def _card_keyword(card):
+    card = card.decode('ascii', errors='replace')
+    if card.startswith('HIERARCH ') and '=' in card:
+        return card[9:card.index('=')].strip().upper()
+    return card[:8].strip().upper()
+
+
+def _update_checksum(header, icard_checksum, icard_datasum):
+    '''Set the CHECKSUM card of the raw header from its DATASUM, so the data
+    doesnt need to be read'''
+    datasum = fits.Card.fromstring(bytes(header[
+        icard_datasum*card_length:(icard_datasum+1)*card_length]).decode('ascii'))
+    checkcard = fits.Card.fromstring(bytes(header[
+        icard_checksum*card_length:(icard_checksum+1)*card_length]).decode('ascii'))
+    start = icard_checksum*card_length
+    header[start:start+card_length] = fits.Card(
+        'CHECKSUM', '0' * 16, checkcard.comment).image.encode('ascii')
+    checksum = _encode_checksum(~_checksum32(header, int(datasum.value)) &
+                                0xFFFFFFFF)
+    header[start:start+card_length] = fits.Card(
+        'CHECKSUM', checksum, checkcard.comment).image.encode('ascii')
+
+
+def _checksum32(data, sum32=0):
+    '''The 32 bit ones complement sum of data (a multiple of 4 bytes) as in the
+    FITS checksum convention'''
+    halves = struct.unpack('>{}H'.format(len(data) // 2), bytes(data))
+    hi = (sum32 >> 16) + sum(halves[0::2])
+    lo = (sum32 & 0xFFFF) + sum(halves[1::2])
+    hicarry = hi >> 16
+    locarry = lo >> 16
+    while hicarry or locarry:
+        hi = (hi & 0xFFFF) + locarry
+        lo = (lo & 0xFFFF) + hicarry
+        hicarry = hi >> 16
+        locarry = lo >> 16
+    return (hi << 16) + lo
+
+
+def _encode_checksum(value):
+    '''The 16 character ascii encoding of a checksum'''
+    exclude = [0x3a, 0x3b, 0x3c, 0x3d, 0x3e, 0x3f, 0x40,
+               0x5b, 0x5c, 0x5d, 0x5e, 0x5f, 0x60]
+    asc = [0] * 16
+    for ibyte in range(4):
+        byte = (value >> (24 - 8 * ibyte)) & 0xFF
+        chars = [byte // 4 + 0x30, ] * 4
+        chars[0] += byte % 4
+        check = True
+        while check:
+            check = False
+            for ichar in [0, 2]:
+                while chars[ichar] in exclude or chars[ichar+1] in exclude:
+                    chars[ichar] += 1
+                    chars[ichar+1] -= 1
+                    check = True
+        for ichar in range(4):
+            asc[4 * ichar + ibyte] = chars[ichar]
+    # rotate one to the right
+    return ''.join([chr(asc[(ii + 15) % 16]) for ii in range(16)])
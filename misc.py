@@ -1,10 +1,68 @@
+import os
+import fcntl
+import socket
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 from astropy.time import Time
 
+# mjd 0 as date
+_mjd_zero = np.datetime64('1858-11-17', 'D')
+# flock doesnt always exclude threads of the same process (e.g. on NFS)
+_file_lock = threading.Lock()
+
 
 def find_night(dtime):
-    dtime = Time(dtime, format='mjd')
-    if (dtime.mjd % 1) >= 0.5:  # evening
-        return Time(dtime.iso[:10], format='iso')
-    else:  # morning. previous day
-        return Time(Time((dtime.jd - 1), format='jd').iso[:10], format='iso')
+    '''Return the night of the mjd dtime as Time of the date the night started.
+    Use find_nights for many dates.'''
+    return Time(float(find_nights(dtime)), format='mjd')
+
+
+def find_nights(mjds, labels=False):
+    '''Return the night of each mjd as integer mjd of the date the night started.
+    Observations before noon (UTC) belong to the previous night.
+    labels=False
+    set to True to return the nights as yyyymmdd strings instead'''
+    nights = np.floor(np.asarray(mjds, dtype=float) - 0.5).astype(np.int64)
+    if labels:
+        return mjd2label(nights)
+    return nights
+
+
+def mjd2label(mjds):
+    '''Convert (integer) mjds to yyyymmdd strings'''
+    dates = _mjd_zero + np.floor(np.asarray(mjds, dtype=float)).astype(
+        np.int64).astype('timedelta64[D]')
+    return np.char.replace(np.datetime_as_string(dates, unit='D'), '-', '')
+
+
+@contextmanager
+def locked(pnfile):
+    '''Exclusive lock of pnfile (via pnfile.lock) against other threads,
+    processes and nodes sharing the file system. Dont nest it.'''
+    with _file_lock, open(pnfile+'.lock', 'a') as flock:
+        fcntl.flock(flock.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(flock.fileno(), fcntl.LOCK_UN)
+
+
+def tmp_name(pnfile):
+    '''A temporary file name next to pnfile, unique over threads, processes
+    and nodes'''
+    return '{}.{}-{}-{}.tmp'.format(pnfile, socket.gethostname(), os.getpid(),
+                                    threading.get_ident())
+
 
+def process_pool(nworkers=None):
+    '''A process pool which can be used while other threads run (e.g. the
+    reduction threads of down_reduce): its workers are started by a fork
+    server or spawned instead of forking the threaded process'''
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+    else:
+        context = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(max_workers=nworkers, mp_context=context)
@@ -3,17 +3,30 @@ import numpy as np
 import astropy.units as u
 from astropy.table import Table, vstack
 import re
+import json
+import time
+import hashlib
+import sqlite3
 import warnings
 from glob import glob
-from misc import find_night
-from starclass import Star
-from subprocess import Popen, PIPE
+from misc import find_nights, locked, tmp_name
+from header_index import get_headers, update_index
+from header_patch import patch_headers
+from stellar_metadata import get_stellar_metadata, reffile_entry
+from subprocess import Popen, PIPE, STDOUT, check_output
 from astropy.io import fits
 from shutil import copy
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    as_completed
 from config import ceres_dir, default_science_dir, default_calib_dir, \
-    default_log_dir
+    default_log_dir, default_eso_user, default_astroquery_dir, default_link_mode
 
+# lines of the CERES output to look for
+rv_regex = re.compile(r'Achievable RV precision is\s+([0-9]*\.[0-9]+)')
+progress_regex = re.compile(r'Working on')  # printed once per science frame
+# ids of the ESO archive files, e.g. FEROS.2017-01-01T01:02:03.456
+archive_id_regex = re.compile(r'^[A-Z0-9_]+\.\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}$')
 
 if __name__ == '__main__':
     print('Processing all files in current directory. Assuming they are \
@@ -40,7 +53,7 @@ def show_pdfs(target, prog=None,
 def _all_targets(science_dir=None, npools=10,
                 do_class=False, extra_calib_dir=False,
                 calib_dir=None, ignore_dirs=[],
-                only_dirs=[]):
+                only_dirs=[], log_dir=None):
     '''Running CERES-FEROS pipeline on all subfolders. Assuming the folders are sorted
     by Target only, e.g. ./direct/HD10000/sciencefiles.fits - unless extra_calib_dir=True
     Use all_subfolders routine of the same module to reduce files also sorted by
@@ -53,9 +66,14 @@ def _all_targets(science_dir=None, npools=10,
     by date only, e.g. ./calibdir/311220000/calibfiles.fits
     The calibfiles are then copied to the sciencefiles, processed and deleted again to
     save memory
-    ignore_dirs=[] and only_dirs=[] can be used to reduce only certain folders'''
+    ignore_dirs=[] and only_dirs=[] can be used to reduce only certain folders
+    log_dir=None
+    folder of the header index, the stellar metadata cache and the header
+    change log. Uses the default_log_dir if None'''
     if science_dir is None:
         science_dir = default_science_dir
+    if log_dir is None:
+        log_dir = default_log_dir
     if extra_calib_dir and calib_dir is None:
         calib_dir = default_calib_dir
     elif calib_dir is None:
@@ -76,9 +94,11 @@ def _all_targets(science_dir=None, npools=10,
             if len(scfiles) == 0:
                 print('Didnt find any observations for {}. Skipping it'.format(tarname))
                 continue
-            nights = [find_night(fits.getheader(ffile.path)['MJD-OBS'])
-                      for ffile in scfiles]
-            nights = np.unique(nights)
+            headers = get_headers([ffile.path for ffile in scfiles],
+                                  pnindex=os.path.join(log_dir,
+                                                       'header_index.sqlite'))
+            nights = np.unique(find_nights([header['mjd'] for header in
+                                            headers.values()], labels=True))
             print('Processing target {} with {} different nights'.format(tarname, len(nights)))
             # store the calibfiles which are copied later and then deleted if extra_calib_dir
             calibfiles = []
@@ -98,7 +118,8 @@ def _all_targets(science_dir=None, npools=10,
             fitsfiles = [ffile.name for ffile in os.scandir(tardir) if (
                     ffile.name.endswith('.fits') and ffile.is_file())
                          and ffile.name.startswith('FEROS')]
-            _make_reffile(tarname, tardir, fitsfiles)
+            _make_reffile(tardir.path, fitsfiles, science_dir=science_dir,
+                          tarname=tarname, log_dir=log_dir)
             os.chdir(ceres_dir)
 
             _run_ferospipe(do_class=do_class, root=tardir.path,
@@ -113,146 +134,454 @@ def _all_targets(science_dir=None, npools=10,
 def all_subfolders(direct=None, npools=4,
                    do_class=False, show_pdfs=False,
                    pnreffile=None,
-                   log_dir=None):
+                   log_dir=None, ncores=None, policy='balanced',
+                   force=False, progress_callback=None):
     '''runs the feros ceres pipeline on all subfolders of the directory which have
     at least 16 .fits files in it and do not end on _red. Use this routine if your
     files are sorted by date only.
     pnreffile=None
     provied the path to the reffile for CERES. If not provided, will try to find the
     logs from the download sequence to identify the targets to decide which mask to 
-    use.'''
+    use.
+    ncores=None
+    total number of cores to use. If None, one folder after the other is reduced
+    with npools cores
+    policy='balanced'
+    how to split ncores between folders reduced in parallel and the npools of CERES.
+    'inner': one folder at a time using all ncores in CERES
+    'outer': as many folders in parallel as possible with one core each
+    'balanced': ncores//npools folders in parallel with npools cores each
+    The folders which took longest in the previous runs (stored in
+    reduction_walltimes.json in the log_dir) are reduced first.
+    force=False
+    Folders whose fits files, reffile entries, CERES version and do_class did not
+    change since their last reduction (stored in reduction_state.json in the
+    log_dir) are skipped. Set to True to reduce them anyway.
+    progress_callback=None
+    passed to _run_ferospipe. Return True from it to stop CERES on a folder.'''
     if direct is None:
         direct = os.path.abspath(default_science_dir)
     if log_dir is None:
         log_dir = os.path.abspath(default_log_dir)
     if pnreffile is None:
-        pnreffle = os.path.abspath(os.path.join(log_dir, 'reffile.txt'))
+        pnreffile = os.path.abspath(os.path.join(log_dir, 'reffile.txt'))
     else:
         pnreffile = os.path.abspath(pnreffile)
-    home_dir = os.getcwd()
-    os.chdir(ceres_dir)
+    if ncores is None:
+        ncores = npools
+        policy = 'inner'
+    rootdirs = {}
     for root, subdirs, files in tqdm(os.walk(direct)):
         fits_files = [x for x in files if x.endswith('.fits')]
         # at least 5+10+12(6) calibration files + 1 science
         if len(fits_files) >= 16 and not root.endswith('_red') and not root.endswith('proc'):
+            rootdirs[root] = len(fits_files)
+        else:
+            print('\n Ignoring folder {} as it has less than 16 files, is "proc" or ends with "_red"'.format(
+                root))
 
-            print('\n\
+    pnstate = os.path.join(log_dir, 'reduction_state.json')
+    states = _load_json(pnstate)
+    # read all new headers at once in parallel
+    update_index(direct, pnindex=os.path.join(log_dir, 'header_index.sqlite'))
+    inputs = reduction_inputs(log_dir)
+    refnames, metadata, downloadlog, ceres_version = [inputs[key] for key in [
+        'refnames', 'metadata', 'downloadlog', 'ceres_version']]
+    fingerprints = {}
+    for root in list(rootdirs.keys()):
+        tarnames = _write_tarnames2header_and_reffile(root, log_dir,
+                                                      refnames=refnames,
+                                                      metadata=metadata,
+                                                      downloadlog=downloadlog)
+        # after writing the headers, as this changes the files
+        fingerprints[root] = _reduction_fingerprint(root, tarnames, pnreffile,
+                                                    ceres_version, do_class)
+        if not force and states.get(root) == fingerprints[root] and \
+           os.path.exists(root+'_red'):
+            print('Skipping {} as it did not change since its last reduction'.format(
+                root))
+            del rootdirs[root]
+
+    pnwalltimes = os.path.join(log_dir, 'reduction_walltimes.json')
+    walltimes = _load_json(pnwalltimes)
+    # longest first. Folders without previous runs by their number of files
+    roots = sorted(rootdirs.keys(), reverse=True,
+                   key=lambda root: (walltimes.get(root, -1.),
+                                     rootdirs[root]))
+    nouter, ninner = _split_cores(ncores, len(roots), npools, policy)
+    print('Reducing {} folders, {} in parallel with {} cores each'.format(
+        len(roots), nouter, ninner))
+
+    def reduce_root(root):
+        print('\n\
                    #######################################################\n\
                    Processing dir %s containing %d fits-files\n\
-                   #######################################################\n'%(root,len(fits_files)))
-                  
+                   #######################################################\n'%(root, rootdirs[root]))
+        tstart = time.time()
+        returncode = _run_ferospipe(do_class=do_class, root=root, npools=ninner,
+                                    pnreffile=pnreffile,
+                                    progress_callback=progress_callback)
+        _update_json(pnwalltimes, root, time.time() - tstart)
+        if returncode == 0:
+            _update_json(pnstate, root, fingerprints[root])
 
-            _write_tarnames2header_and_reffile(root, log_dir)
-            _run_ferospipe(do_class=do_class, root=root, npools=npools,
-                           pnreffile=pnreffile)
-        else:
-            print('\n Ignoring folder {} as it has less than 16 files, is "proc" or ends with "_red"'.format(
-                root))
+    with ThreadPoolExecutor(max_workers=nouter) as pool:
+        futures = [pool.submit(reduce_root, root) for root in roots]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            future.result()
 
-    os.chdir(home_dir)
     print('Done reducing all subfolders in %s (successfully?)'%direct)
     if show_pdfs:
         print('Opening the pdfs')
         show_pdfs(direct)
 
 
-def check_fits_files(check_dir=os.getcwd(), recursive=True):
+def reduction_inputs(log_dir=None):
+    '''Read the reffile names and the download log of the log_dir, resolve
+    all targets of the download log at once and get the CERES version.
+    Returns them as dict of the keywords of reduce_folder, so they are only
+    determined once when reducing many folders'''
+    if log_dir is None:
+        log_dir = os.path.abspath(default_log_dir)
+    refnames = _load_reffile_names(os.path.join(log_dir, 'reffile.txt'))
+    downloadlog = _load_downloadlog(log_dir)
+    metadata = get_stellar_metadata(
+        [tarname for tarname in set(downloadlog.values())
+         if tarname not in refnames],
+        pncache=os.path.join(log_dir, 'stellar_metadata.csv'))
+    return {'refnames': refnames, 'metadata': metadata,
+            'downloadlog': downloadlog, 'ceres_version': _ceres_version()}
+
+
+def reduce_folder(root, npools=4, do_class=False, pnreffile=None, log_dir=None,
+                  force=False, progress_callback=None, refnames=None,
+                  metadata=None, downloadlog=None, ceres_version=None):
+    '''Reduce a single night folder like all_subfolders does: the target names
+    are written to the headers and the reffile, and the folder is skipped if
+    it did not change since its last reduction (unless force=True). The state
+    and walltime files in the log_dir are shared with all_subfolders and can
+    be used by several nodes at once. Returns the returncode of CERES (0 if the
+    folder was skipped).
+    refnames=None, metadata=None, downloadlog=None
+    from reduction_inputs. Read for this folder if None
+    ceres_version=None
+    from _ceres_version. Determined if None'''
+    root = os.path.abspath(root)
+    if log_dir is None:
+        log_dir = os.path.abspath(default_log_dir)
+    if pnreffile is None:
+        pnreffile = os.path.abspath(os.path.join(log_dir, 'reffile.txt'))
+    else:
+        pnreffile = os.path.abspath(pnreffile)
+    pnstate = os.path.join(log_dir, 'reduction_state.json')
+    pnwalltimes = os.path.join(log_dir, 'reduction_walltimes.json')
+    if ceres_version is None:
+        ceres_version = _ceres_version()
+    tarnames = _write_tarnames2header_and_reffile(root, log_dir,
+                                                  refnames=refnames,
+                                                  metadata=metadata,
+                                                  downloadlog=downloadlog)
+    fingerprint = _reduction_fingerprint(root, tarnames, pnreffile,
+                                         ceres_version, do_class)
+    if not force and _load_json(pnstate).get(root) == fingerprint and \
+       os.path.exists(root+'_red'):
+        print('Skipping {} as it did not change since its last reduction'.format(
+            root))
+        return 0
+    print('Processing dir {}'.format(root))
+    tstart = time.time()
+    returncode = _run_ferospipe(do_class=do_class, root=root, npools=npools,
+                                pnreffile=pnreffile,
+                                progress_callback=progress_callback)
+    _update_json(pnwalltimes, root, time.time() - tstart)
+    if returncode == 0:
+        _update_json(pnstate, root, fingerprint)
+    return returncode
+
+
+def _load_json(pnjson):
+    if not os.path.exists(pnjson):
+        return {}
+    with open(pnjson, 'r') as fjson:
+        return json.load(fjson)
+
+
+def _update_json(pnjson, key, value):
+    '''Set key in the json dict pnjson. Locked, so threads and processes (also
+    on other nodes) dont overwrite each others entries'''
+    with locked(pnjson):
+        entries = _load_json(pnjson)
+        entries[key] = value
+        pntmp = tmp_name(pnjson)
+        with open(pntmp, 'w') as fjson:
+            json.dump(entries, fjson, indent=1)
+        os.replace(pntmp, pnjson)
+
+
+def _reduction_fingerprint(root, tarnames, pnreffile, ceres_version,
+                           do_class):
+    '''Hash of everything the reduction of root depends on: names, sizes and
+    modification times of the fits files, the reffile entries of the tarnames,
+    the CERES version and do_class'''
+    fitsfiles = sorted([(ff.name, ff.stat().st_size, ff.stat().st_mtime)
+                        for ff in os.scandir(root) if ff.name.endswith('.fits')
+                        and ff.is_file()])
+    refentries = []
+    if os.path.exists(pnreffile):
+        with open(pnreffile, 'r') as freff:
+            refentries = sorted([line.strip() for line in freff
+                                 if line.split(',')[0].strip() in tarnames])
+    state = json.dumps([fitsfiles, refentries, ceres_version, bool(do_class)])
+    return hashlib.sha1(state.encode('utf-8')).hexdigest()
+
+
+def _ceres_version():
+    '''The git commit of CERES or None if it is not a git repository'''
+    try:
+        return check_output(['git', '-C', ceres_dir, 'rev-parse', 'HEAD'],
+                            stderr=PIPE).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def _split_cores(ncores, ndirs, npools=4, policy='balanced'):
+    '''Split ncores between the number of folders reduced in parallel and the
+    npools given to CERES. Returns (nouter, ninner).'''
+    ndirs = max(ndirs, 1)
+    if policy == 'inner':
+        nouter = 1
+    elif policy == 'outer':
+        nouter = min(ncores, ndirs)
+    elif policy == 'balanced':
+        nouter = min(max(ncores // max(npools, 1), 1), ndirs)
+    else:
+        raise ValueError('Unknown policy {}. Use inner, outer or balanced'.format(
+            policy))
+    ninner = max(ncores // nouter, 1)
+    return nouter, ninner
+
+
+def check_fits_files(check_dir=os.getcwd(), recursive=True, nworkers=None,
+                     pncache=None, redownload=False, eso_user=None,
+                     raw_only=True):
     '''Some fits files get downloaded wrongly. Check recursively. 
     Check the checksums
     and notify those not openable or with wrong checksum. Also store
-    their folder so they can be redownloaded'''
+    their folder so they can be redownloaded.
+    The files are checked in parallel by nworkers processes. The results are
+    stored in pncache (fits_check_cache.sqlite in the default_log_dir if None)
+    by path, size and mtime, so only new or changed files are checked again.
+    redownload=False
+    set to True to download the failed files again (see redownload_failed)
+    raw_only=True
+    skip the products of the reduction (in folders ending on _red or proc)'''
     if os.path.isfile(check_dir):
-        ffiles = [ffiles, ]
+        ffiles = [check_dir, ]
     else:
         if recursive:
             ffiles = glob(os.path.join(check_dir, '**/*.fits'),
                           recursive=True)
         else:
             ffiles = glob(os.path.join(check_dir, '*.fits'))
+        if raw_only:
+            ffiles = [ffile for ffile in ffiles if not any(
+                [part.endswith('_red') or part.endswith('proc') for part in
+                 os.path.dirname(os.path.abspath(ffile)).split(os.sep)])]
         ffiles = sorted(ffiles)
-    failsizes = []
-    failfiles = []
-    failreasons = []
-    
-    print('Checking {} files in {}'.format(len(ffiles), check_dir))
-    with warnings.catch_warnings():
-        warnings.filterwarnings('error')
-        for ffile in tqdm(ffiles):
-            try:
-                hdul = fits.open(ffile, checksum=True)
-                hdul.close()
-                continue
-            except Warning:
-                print('ChecksumError found')
-                failreasons.append('checksumError')
-            except:
-                failreasons.append('notOpenable')
-            failsizes.append(os.path.getsize(ffile))
-            failfiles.append(ffile)
-            hdul.close()
+    ffiles = [os.path.abspath(ffile) for ffile in ffiles]
+    if pncache is None:
+        pncache = os.path.join(default_log_dir, 'fits_check_cache.sqlite')
+    con = sqlite3.connect(pncache, timeout=60)
+    con.execute('CREATE TABLE IF NOT EXISTS verdicts (path TEXT PRIMARY KEY, \
+size INTEGER, mtime REAL, reason TEXT)')
+    verdicts = dict([(row[0], row[1:]) for row in
+                     con.execute('SELECT path, size, mtime, reason FROM verdicts')])
+    reasons = {}
+    todo = []
+    for ffile in ffiles:
+        stat = os.stat(ffile)
+        if verdicts.get(ffile, [None, None])[:2] == (stat.st_size, stat.st_mtime):
+            reasons[ffile] = verdicts[ffile][2]
+        else:
+            todo.append((ffile, stat.st_size, stat.st_mtime))
+
+    print('Checking {} files in {} ({} unchanged files known already)'.format(
+        len(todo), check_dir, len(ffiles) - len(todo)))
+    tstart = time.time()
+    with ProcessPoolExecutor(max_workers=nworkers) as pool:
+        todo_reasons = list(tqdm(pool.map(_check_fits_file,
+                                          [ffile for ffile, size, mtime in todo],
+                                          chunksize=20), total=len(todo)))
+    dtime = max(time.time() - tstart, 1e-6)
+    nbytes = sum([size for ffile, size, mtime in todo])
+    print('Checked {} files ({:.1f} GB) in {:.1f}s: {:.1f} files/s, {:.1f} MB/s'.format(
+        len(todo), nbytes / 1e9, dtime, len(todo) / dtime, nbytes / 1e6 / dtime))
+    with con:
+        con.executemany('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?)',
+                        [(ffile, size, mtime, reason) for (ffile, size, mtime), reason
+                         in zip(todo, todo_reasons)])
+    con.close()
+    for (ffile, size, mtime), reason in zip(todo, todo_reasons):
+        reasons[ffile] = reason
+
+    failfiles = [ffile for ffile in ffiles if reasons[ffile] != '']
+    failreasons = [reasons[ffile] for ffile in failfiles]
+    failsizes = [os.path.getsize(ffile) for ffile in failfiles]
     tfailed = Table([failreasons, failsizes, failfiles],
-                    names=('reason', 'size', 'path'))
+                    names=('reason', 'size', 'path'), dtype=(str, int, str))
     tfailed['size'].unit = u.byte
+    print('{} of {} files failed the check'.format(len(tfailed), len(ffiles)))
+    if redownload and len(tfailed) > 0:
+        redownload_failed(tfailed, eso_user=eso_user)
     return tfailed
 
 
+def _check_fits_file(ffile):
+    '''Return why the fits file is broken ('checksumError' or 'notOpenable')
+    or an empty string if it is fine'''
+    with warnings.catch_warnings():
+        warnings.filterwarnings('error')
+        try:
+            hdul = fits.open(ffile, checksum=True)
+            hdul.close()
+            return ''
+        except Warning:
+            print('ChecksumError found in {}'.format(ffile))
+            return 'checksumError'
+        except:
+            return 'notOpenable'
+
+
+def redownload_failed(tfailed, eso_user=None, astroquery_dir=None,
+                      store_pwd=False, link_mode=None):
+    '''Download the files in the table returned by check_fits_files again,
+    replacing the broken ones in the cache and at their path. Files whose
+    names are no ESO archive ids (e.g. reduction products) are skipped'''
+    from download_sort import download_id, compress_files, extract_files, \
+        _place_file
+    if eso_user is None:
+        eso_user = default_eso_user
+    if link_mode is None:
+        link_mode = default_link_mode
+    ids = []
+    pnfailed = []
+    for pn in tfailed['path']:
+        iid = os.path.basename(pn)[:-len('.fits')]
+        if archive_id_regex.match(iid) is None:
+            print('Not downloading {} again as it is no archive file'.format(pn))
+            continue
+        ids.append(iid)
+        pnfailed.append(pn)
+    if astroquery_dir is None:
+        astroquery_dir = default_astroquery_dir
+    # remove the (probably also broken) cached files first
+    if astroquery_dir is not None:
+        for iid in ids:
+            for ending in ['.fits', '.fits.Z']:
+                if os.path.isfile(os.path.join(astroquery_dir, iid+ending)):
+                    os.remove(os.path.join(astroquery_dir, iid+ending))
+    print('Downloading {} broken files again'.format(len(ids)))
+    cache_dir = download_id(ids, eso_user, astroquery_dir=astroquery_dir,
+                            store_pwd=store_pwd)
+    compress_files(cache_dir, fileending='.fits')
+    replaced = []
+    for iid, pn in zip(ids, pnfailed):
+        pncache = os.path.join(cache_dir, iid+'.fits.Z')
+        if not os.path.isfile(pncache):
+            print('Could not download {} again'.format(iid))
+            continue
+        for pnold in [pn, pn+'.Z']:
+            if os.path.isfile(pnold):
+                os.remove(pnold)
+        _place_file(pncache, pn+'.Z', link_mode=link_mode)
+        replaced.append(pn+'.Z')
+    extract_files(cache_dir, overwrite_old=True, filelist=replaced)
+    return replaced
+
+
 def _run_ferospipe(do_class=False, root=os.getcwd(),
-                   npools=4, pnreffile=None):
+                   npools=4, pnreffile=None, progress_callback=None,
+                   echo=False):
+    '''Run CERES on root. The output is written line by line to
+    <root>_red/output.txt and the achievable RV precisions to
+    <root>_red/achievable_rvs.txt while CERES is running. A progress bar
+    counts the frames CERES has worked on.
+    progress_callback=None
+    called for every line of output as progress_callback(root, line, nframes, rvs)
+    with the number of frames done and the RV precisions found so far. If it
+    returns True, CERES is stopped.
+    echo=False
+    set to True to also print the output of CERES
+    Returns the return code of CERES.'''
     if pnreffile is None:
         pnreffile=os.path.join(root, 'reffile.txt')
-    predir = os.getcwd()
     print('Running pipeline on folder {}'.format(root))
-    os.chdir(os.path.join(ceres_dir, 'feros'))
-    if os.path.exists("ferospipe_fp.py"):
+    # dont chdir, as several pipelines may be started in parallel
+    feros_dir = os.path.join(ceres_dir, 'feros')
+    if os.path.exists(os.path.join(feros_dir, "ferospipe_fp.py")):
         pipeline = "ferospipe_fp.py"
     else:
         pipeline = "ferospipe.py"
     if do_class:
 
-        p = Popen(["python2", pipeline, root,
+        p = Popen(["python2", "-u", pipeline, root,
                    "-npools", str(npools), "-do_class",
                    "-reffile", pnreffile],
-                  stdin=PIPE, stdout=PIPE, stderr=PIPE)
+                  stdin=PIPE, stdout=PIPE, stderr=STDOUT, cwd=feros_dir,
+                  universal_newlines=True, bufsize=1)
     else:
-        p = Popen(["python2", pipeline, root, "-npools",
+        p = Popen(["python2", "-u", pipeline, root, "-npools",
                    str(npools), 
-                   "-reffile", os.path.join(root, 'reffile.txt')],
-                  stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    os.chdir(predir)
-    # for stdout_line in iter(p.stdout.readline, ""):
-        #print(stdout_line)
-    output, err = p.communicate()
-    output = output.decode('utf-8')
-    err = err.decode('utf-8')
-    print(str(output), str(err))
+                   "-reffile", pnreffile],
+                  stdin=PIPE, stdout=PIPE, stderr=STDOUT, cwd=feros_dir,
+                  universal_newlines=True, bufsize=1)
+    p.stdin.close()
     if not os.path.exists(root+'_red'):
         os.mkdir(root+'_red')
     fnoutput = root+'_red/output.txt'
-    with open(fnoutput, 'w+') as outputfile:
-        outputfile.write(str(output)+'\n'+'Erroroutput:\n'+str(err))
-    #rc = p.returncode
-    p.stdout.close()
-    regex = re.compile('Achievable RV precision is\s+[0-9]*\.[0-9]+')
-    rvs = [x[26::].strip() for x in regex.findall(output)]
     fnrv = root+'_red/achievable_rvs.txt'
-    rvfile = open(fnrv,'w+')
-    for entry in rvs:
-        rvfile.write("%s\n"%entry)
-    rvfile.close()
+    rvs = []
+    nframes = 0
+    with open(fnoutput, 'w+') as outputfile, open(fnrv, 'w+') as rvfile, \
+         tqdm(desc=os.path.basename(root), unit=' frames') as pbar:
+        for line in p.stdout:
+            outputfile.write(line)
+            outputfile.flush()
+            if echo:
+                print(line, end='')
+            rvmatch = rv_regex.search(line)
+            if rvmatch is not None:
+                rvs.append(rvmatch.group(1))
+                rvfile.write("%s\n"%rvs[-1])
+                rvfile.flush()
+            if progress_regex.search(line) is not None:
+                nframes += 1
+                pbar.update(1)
+            if progress_callback is not None and \
+               progress_callback(root, line, nframes, rvs):
+                print('Stopping CERES on {} as requested by the progress_callback'.format(
+                    root))
+                p.kill()
+                break
+    p.stdout.close()
+    p.wait()
     print('achieveable rvs: %s(saved in %s):'%(rvs, fnrv))
+    return p.returncode
 
     
-def _make_reffile(root, fits_files, science_dir=None, tarname=None):
+def _make_reffile(root, fits_files, science_dir=None, tarname=None,
+                  log_dir=None):
     '''A routine to make the reffile for the CERES pipeline. The coordinates are
     used from the header, the mask is determined via SIMBAD. If not found,
     G2 is used.'''
     if science_dir is None:
         science_dir = default_science_dir
-    science_fits = [os.path.join(root, ff) for ff in fits_files if
-                    str(fits.getheader(
-                        os.path.join(root,
-                                     ff))['ESO DPR CATG']).upper().strip()
-                    == 'SCIENCE']
+    if log_dir is None:
+        log_dir = default_log_dir
+    headers = get_headers([os.path.join(root, ff) for ff in fits_files],
+                          pnindex=os.path.join(log_dir, 'header_index.sqlite'))
+    science_fits = [pn for pn, header in headers.items() if
+                    str(header['catg']).upper().strip() == 'SCIENCE']
     # targets = []
     # if there is no fscience file found and the number corresponds to a
     # possible calib number, dont process this folder
@@ -264,121 +593,128 @@ files.'.format(root))
         with open(os.path.join(science_dir, 'unreduced_folders.txt'), 'a+') as f:
             f.write(root+'\n')
     else:
-        starget = Star(tarname)
+        entry = get_stellar_metadata([tarname, ], pncache=os.path.join(
+            log_dir, 'stellar_metadata.csv')).get(tarname)
+        if entry is None:
+            warnings.warn('Couldnt automatically find parameters for {}. \
+Using mask G2 and no proper motion'.format(tarname))
+            entry = {'tarname': tarname, 'ra': None, 'dec': None,
+                     'pmra': 0., 'pmdec': 0., 'mask': 'G2'}
         if len(science_fits) == 0:
             warnings.warn('No fits file found for target {}. Using coordinates also from Simbad'.format(tarname))
-            starget.coordinates = 'auto'
+            ra, dec = entry['ra'], entry['dec']
         else:
+            changes = {}
             for st in science_fits:
-                headername = str(fits.getheader(st)['OBJECT'].upper().strip())
+                headername = str(headers[st]['object']).upper().strip()
                 if headername != tarname:
                     warnings.warn('Name of target ({}) is {} in header of file {}. \
                     Continuing using name {} and changing it in header for CERES to work'.format(
                         tarname, headername, st, tarname))
-                    dat, head = fits.getdata(st, header=True)
-                    head['OBJECT'] = tarname
-                    fits.writeto(st, dat, header=head, overwrite=True,
-                                 output_verify='warn')
-            stheader = fits.getheader(science_fits[0])
-            starget.coordinates = [[stheader['RA'], stheader['DEC']],
-                                   [u.deg, u.deg], 'icrs']
-        starget.pm = 'auto'
-        #except:
-        #    print('Couldnt get pm for {}. Setting it to 0'.format(starget.sname))
-        #    starget.pm = [0., 0.] * u.mas/u.yr
-        try:
-            starget.get_SpT()
-            assert np.isfinite(starget.SpT_num())  # try it can be converted to num value
-            print('Found SpT for {} on Simbad as {}'.format(starget.sname,
-                                                            starget.SpT))
-        except:
-            print('Couldnt find SpT on Simbad for {}. \
-    Setting it to G2III'.format(starget.sname))
-            starget.SpT = ('G2V')
+                    changes[st] = {'OBJECT': tarname}
+            patch_headers(changes, pnlog=os.path.join(log_dir,
+                                                      'header_changes.csv'))
+            stheader = headers[science_fits[0]]
+            ra, dec = stheader['ra'], stheader['dec']
+        if ra is None or dec is None:
+            warnings.warn('No coordinates found for {}. Not writing it to the \
+reffile'.format(tarname))
+            return
         # determine which of the three masks to use. 05III has numerical val 15
-        print('Using mask {}'.format(mask))
+        print('Using mask {}'.format(entry['mask']))
         with open(os.path.join(root, 'reffile.txt'), 'a') as reff:
-            reff.write('{},{},{},{},{},{},{},{}\n'.format(
-                starget.sname,
-                starget.coordinates.ra.to_string(u.hourangle, sep=':'),
-                starget.coordinates.dec.to_string(u.degree, sep=':'),
-                starget.pm[0].to('mas / yr').value,
-                starget.pm[1].to('mas / yr').value,
-                0,
-                mask,
-                10.0))
-
-
-def _write_tarnames2header_and_reffile(direct, log_dir):
+            reff.write(reffile_entry(entry, userefcoords=0, ra=ra, dec=dec))
+
+
+def _write_tarnames2header_and_reffile(direct, log_dir, refnames=None,
+                                       metadata=None, downloadlog=None):
     '''Find the tarnames of the files. They should be stored in a file created by the
-    download routine.'''
-    sciencefiles = [os.path.abspath(os.path.join(direct, f)) for f in os.listdir(direct) \
-                    if f.endswith('.fits') and \
-                     fits.getheader(os.path.join(direct, f))['ESO DPR CATG'].strip().upper() \
-                    == 'SCIENCE']
+    download routine. Returns the tarnames found.
+    refnames=None, metadata=None
+    the names in the reffile and the stellar metadata, see _update_reffile
+    downloadlog=None
+    dict of the science file paths and their tarnames from _load_downloadlog.
+    Is read from the log_dir if None'''
+    headers = get_headers([os.path.join(direct, f) for f in os.listdir(direct)
+                           if f.endswith('.fits')],
+                          pnindex=os.path.join(log_dir, 'header_index.sqlite'))
+    sciencefiles = [pn for pn, header in headers.items() if
+                    str(header['catg']).strip().upper() == 'SCIENCE']
 
-    pndownloadlog = os.path.join(log_dir, 'science_files.csv')
-    if not os.path.exists(pndownloadlog):
-        raise FileNotFoundError('File {} not found with the queried targetnames. But it is \
-needed to identify the different sciencefiles.'.format(pndownloadlog))
-    tdownloadlog = Table.read(os.path.join(log_dir, 'science_files.csv'), delimiter=',',
-                                          names=['tarnamequery', 'abspath', 'querydate'])
+    if downloadlog is None:
+        downloadlog = _load_downloadlog(log_dir)
+    tarnames = []
+    changes = {}
     for sf in sciencefiles:
-        if sf in tdownloadlog['abspath']:
+        if sf in downloadlog:
             # update headername
-            tarnamefits = fits.getheader(sf)['OBJECT']
-            tarnamequery = tdownloadlog['tarnamequery'][tdownloadlog['abspath']==sf][0]
+            tarnamefits = headers[sf]['object']
+            tarnamequery = downloadlog[sf]
             if tarnamefits != tarnamequery:
                 print('Replacing header name {} by queryname {}'.format(
                     tarnamefits, tarnamequery))
-                with fits.open(sf, mode='update') as hdul:
-                     hdul[0].header['OBJECT'] = tarnamequery
-                     hdul.flush()
+                changes[sf] = {'OBJECT': tarnamequery}
             # write reffile
-            _update_reffile(os.path.join(log_dir, 'reffile.txt'), tarnamequery)
+            _update_reffile(os.path.join(log_dir, 'reffile.txt'), tarnamequery,
+                            refnames=refnames, metadata=metadata)
             print('Found sciencefile for target {}'.format(tarnamequery))
+            if tarnamequery not in tarnames:
+                tarnames.append(tarnamequery)
             
         else:
             warnings.warn('Unknown sciencefile {}. Letting CERES find parameters'.format(sf))
+    patch_headers(changes, pnlog=os.path.join(log_dir, 'header_changes.csv'))
+    return tarnames
+
 
+def _load_downloadlog(log_dir):
+    '''Read the science_files.csv written by the download routines into a dict of
+    the absolute path of each science file and its queried target name. For
+    files logged several times the first entry is used.'''
+    pndownloadlog = os.path.join(log_dir, 'science_files.csv')
+    if not os.path.exists(pndownloadlog):
+        raise FileNotFoundError('File {} not found with the queried targetnames. But it is \
+needed to identify the different sciencefiles.'.format(pndownloadlog))
+    downloadlog = {}
+    with open(pndownloadlog, 'r') as flog:
+        for line in flog:
+            entries = [entry.strip() for entry in line.split(',')]
+            if len(entries) < 2 or entries[1] == '':
+                continue
+            downloadlog.setdefault(entries[1], entries[0])
+    return downloadlog
 
-def _update_reffile(pnreffile, tarname):
-    reffilecolnames = ['tarname', 'RA', 'DEC', 'pmRA', 'pmDEC', 'userefcoords',
-                                     'mask', 'vsini']
 
-    if os.path.exists(pnreffile):
-        treffile = Table.read(pnreffile, delimiter=',', format='ascii.no_header',
-                              names=reffilecolnames,
-                              )
-    else:
-        treffile = Table([[]]*8, names=reffilecolnames,)
-    if tarname in treffile['tarname']:
-        pass
-    else:
-        try:
-            star = Star(tarname)
-            star.pm = 'auto'
-            star.coordinates = 'auto'
-            star.get_SpT()
-            if star.SpT_num() >= 70:  # Mstar
-                mask = 'M2'
-            elif star.SpT_num() >= 60:  # Kstar
-                mask = 'K5'
-            else:  # the default mask
-                mask = 'G2'
-            print('Using mask {} for {}'.format(mask, star.sname))
+def _update_reffile(pnreffile, tarname, refnames=None, metadata=None):
+    '''Append the target to the reffile if it is not in there yet.
+    refnames=None
+    set of the names in the reffile, see _load_reffile_names. It is updated
+    with tarname. Reads the reffile if None.
+    metadata=None
+    dict from get_stellar_metadata. The target is resolved if None or not in
+    there'''
+    if refnames is None:
+        refnames = _load_reffile_names(pnreffile)
+    if tarname in refnames:
+        return
+    if metadata is None or tarname not in metadata:
+        metadata = get_stellar_metadata([tarname, ], pncache=os.path.join(
+            os.path.dirname(pnreffile), 'stellar_metadata.csv'))
+    if tarname not in metadata:
+        warnings.warn('Couldnt automatically find parameters for {}'.format(tarname))
+        return
+    with locked(pnreffile):
+        # another worker may have added it meanwhile
+        if tarname not in _load_reffile_names(pnreffile):
             with open(pnreffile, 'a') as reff:
-                reff.write('{},{},{},{},{},{},{},{}\n'.format(
-                    star.sname,
-                    star.coordinates.ra.to_string(u.hourangle, sep=':')[0],
-                    star.coordinates.dec.to_string(u.degree, sep=':')[0],
-                    star.pm[0].to('mas / yr').value,
-                    star.pm[1].to('mas / yr').value,
-                    1,
-                    mask,
-                    10.0 ,))
-                
-        except:
-            import ipdb; ipdb.set_trace()
-            warning.warn('Couldnt automatically find parameters for {}'.format(tarname))
+                reff.write(reffile_entry(metadata[tarname], userefcoords=1))
+    refnames.add(tarname)
+
 
+def _load_reffile_names(pnreffile):
+    '''Return the set of target names in the reffile'''
+    if not os.path.exists(pnreffile):
+        return set()
+    with open(pnreffile, 'r') as freff:
+        return set([line.split(',')[0].strip() for line in freff
+                    if line.strip() != ''])
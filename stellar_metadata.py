@@ -0,0 +1,175 @@
+import os
+import re
+import numpy as np
+import pandas as pd
+import astropy.units as u
+from astropy.coordinates import Angle
+from misc import locked, tmp_name
+from config import default_log_dir
+
+# the cached parameters. ra/dec in deg, pm in mas/yr
+columns = ['tarname', 'ra', 'dec', 'pmra', 'pmdec', 'spt', 'mask']
+# numerical value of the spectral classes. E.g. G2 is 52
+spt_classes = {'O': 10, 'B': 20, 'A': 30, 'F': 40, 'G': 50, 'K': 60, 'M': 70}
+
+
+def get_stellar_metadata(tarnames, pncache=None, resolver=None,
+                         refresh=False):
+    '''Return the coordinates, proper motion, spectral type and CCF mask of the
+    tarnames as dict of tarname and dict of the columns. Targets which are not
+    in the cache (stellar_metadata.csv in the default_log_dir if pncache is None)
+    are resolved with a single call of resolver and added to it. Targets the
+    resolver could not find are missing in the result.
+    resolver=None
+    function taking a list of names and returning a dict of the found names and
+    dicts with ra, dec (deg), pmra, pmdec (mas/yr) and spt. Uses simbad_resolver
+    if None. Give your own to work offline.
+    refresh=False
+    set to True to resolve all tarnames again'''
+    if pncache is None:
+        pncache = os.path.join(default_log_dir, 'stellar_metadata.csv')
+    if resolver is None:
+        resolver = simbad_resolver
+    tarnames = list(dict.fromkeys(tarnames))
+    cache = _read_cache(pncache)
+    missing = [tarname for tarname in tarnames if refresh or tarname not in cache]
+    if len(missing) > 0:
+        print('Resolving {} targets'.format(len(missing)))
+        resolved = resolver(missing)
+        for tarname in missing:
+            if tarname not in resolved:
+                print('Couldnt automatically find parameters for {}'.format(tarname))
+                continue
+            entry = dict(resolved[tarname])
+            entry['tarname'] = tarname
+            entry['mask'] = mask_from_spt(entry.get('spt'))
+            print('Using mask {} for {}'.format(entry['mask'], tarname))
+            cache[tarname] = entry
+        _write_cache(pncache, dict([(tarname, cache[tarname]) for tarname in
+                                    missing if tarname in cache]))
+    return dict([(tarname, cache[tarname]) for tarname in tarnames
+                 if tarname in cache])
+
+
+def mask_from_spt(spt):
+    '''Choose the CERES CCF mask for the spectral type. M2 for M stars, K5 for
+    K stars and G2 for all others or if it is unknown'''
+    sptnum = spt_num(spt)
+    if sptnum >= 70:  # Mstar
+        return 'M2'
+    elif sptnum >= 60:  # Kstar
+        return 'K5'
+    else:  # the default mask
+        return 'G2'
+
+
+def spt_num(spt):
+    '''Numerical value of a spectral type, e.g. 52 for G2V. nan if unknown'''
+    if not isinstance(spt, str):
+        return np.nan
+    match = re.match(r'\s*([OBAFGKM])\s*([0-9](\.[0-9]+)?)?', spt.upper())
+    if match is None:
+        return np.nan
+    sptnum = spt_classes[match.group(1)]
+    if match.group(2) is not None:
+        sptnum += float(match.group(2))
+    return sptnum
+
+
+def reffile_entry(entry, userefcoords=1, ra=None, dec=None, vsini=10.0):
+    '''Line of the CERES reffile for the entry of get_stellar_metadata. ra/dec
+    in deg can be given to replace the cached coordinates'''
+    if ra is None:
+        ra = entry['ra']
+    if dec is None:
+        dec = entry['dec']
+    return '{},{},{},{},{},{},{},{}\n'.format(
+        entry['tarname'],
+        Angle(ra, u.deg).to_string(u.hourangle, sep=':'),
+        Angle(dec, u.deg).to_string(u.degree, sep=':'),
+        entry['pmra'],
+        entry['pmdec'],
+        userefcoords,
+        entry['mask'],
+        vsini)
+
+
+def simbad_resolver(names):
+    '''Query the coordinates, proper motions and spectral types of all names
+    with a single Simbad query'''
+    from astroquery.simbad import Simbad
+    simbad = Simbad()
+    simbad.add_votable_fields('pmra', 'pmdec', 'sptype')
+    result = simbad.query_objects([name.replace('_', ' ') for name in names])
+    resolved = {}
+    if result is None:
+        return resolved
+    colnames = dict([(col.lower(), col) for col in result.colnames])
+    spcol = colnames.get('sp_type', colnames.get('sptype'))
+    for name, row in _match_rows(result, names):
+        if np.ma.is_masked(row[colnames['ra']]) or \
+           str(row[colnames['main_id']]).strip() == '':
+            continue
+        # older versions return sexagesimal coordinates
+        if isinstance(row[colnames['ra']], str):
+            ra = Angle(row[colnames['ra']], u.hourangle).deg
+            dec = Angle(row[colnames['dec']], u.deg).deg
+        else:
+            ra = float(row[colnames['ra']])
+            dec = float(row[colnames['dec']])
+        pmra, pmdec = [0. if np.ma.is_masked(row[colnames[col]]) else
+                       float(row[colnames[col]]) for col in ['pmra', 'pmdec']]
+        resolved[name] = {'ra': ra, 'dec': dec, 'pmra': pmra, 'pmdec': pmdec,
+                          'spt': None if np.ma.is_masked(row[spcol]) else
+                          str(row[spcol]).strip()}
+    return resolved
+
+
+def _match_rows(result, names):
+    '''Pair the rows of a Simbad query_objects result with the queried names.
+    Objects Simbad couldnt resolve are missing in the result, so the rows are
+    matched by the user_specified_id (newer astroquery) or the SCRIPT_NUMBER_ID
+    (older versions) column. Returns a list of (name, row)'''
+    colnames = dict([(col.lower(), col) for col in result.colnames])
+    query_names = [name.replace('_', ' ') for name in names]
+    matched = []
+    for irow, row in enumerate(result):
+        if 'user_specified_id' in colnames:
+            query_name = str(row[colnames['user_specified_id']]).strip()
+            if query_name not in query_names:
+                continue
+            matched.append((names[query_names.index(query_name)], row))
+        elif 'script_number_id' in colnames:
+            # 1 based index of the object in the query
+            matched.append((names[int(row[colnames['script_number_id']]) - 1],
+                            row))
+        elif len(result) == len(names):
+            matched.append((names[irow], row))
+        else:
+            print('Cant match the Simbad results to the {} names'.format(
+                len(names)))
+            return []
+    return matched
+
+
+def _read_cache(pncache):
+    if not os.path.exists(pncache):
+        return {}
+    tcache = pd.read_csv(pncache, sep=',', dtype={'tarname': str, 'spt': str,
+                                                  'mask': str})
+    tcache = tcache.replace({np.nan: None})
+    return dict([(entry['tarname'], entry) for entry in
+                 tcache.to_dict(orient='records')])
+
+
+def _write_cache(pncache, entries):
+    '''Add the entries to the cache. Locked and merged with the current file,
+    so entries of other workers are kept'''
+    with locked(pncache):
+        cache = _read_cache(pncache)
+        cache.update(entries)
+        tcache = pd.DataFrame([cache[tarname] for tarname in sorted(cache.keys())],
+                              columns=columns)
+        pntmp = tmp_name(pncache)
+        tcache.to_csv(pntmp, sep=',', index=False)
+        os.replace(pntmp, pncache)
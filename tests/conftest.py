@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules are not installed, import them from the repository
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
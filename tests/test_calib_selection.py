@@ -0,0 +1,72 @@
+import pytest
+
+pd = pytest.importorskip('pandas')
+pytest.importorskip('astropy')
+pytest.importorskip('astroquery')
+from astropy.time import Time
+import download_sort
+
+# a night of the old calibration plan (before new_calib_mjd)
+night = Time(55197., format='mjd')
+
+
+def calib_rows(mjd0, nbias, nflat, nwave, name):
+    '''a calibration sequence starting at mjd0'''
+    types = ['BIAS', ] * nbias + ['FLAT', ] * nflat + ['WAVE', ] * nwave
+    return [{'Dataset ID': 'FEROS.{}.{}'.format(name, ii),
+             'MJD-OBS': mjd0 + ii * 0.001, 'Type': typ, 'OBJECT': typ,
+             'Exptime': 1. if typ == 'FLAT' else 0., 'Exposure': 0.}
+            for ii, typ in enumerate(types)]
+
+
+def previous_select(t_query, unrobust_calibfiles=True):
+    '''the per-night selection before the candidates were evaluated once'''
+    date, edate = download_sort._calib_dates(night)
+    if len(t_query) > 0:
+        for day, keep in [(date, 'last'), (date, 'first'),
+                          (edate, 'first'), (edate, 'last')]:
+            t_query2 = download_sort.filter_calib(t_query, date=day, keep=keep)
+            if download_sort.check_calib(t_query2):
+                return t_query2['Dataset ID'].tolist(), []
+    if unrobust_calibfiles:
+        return download_sort.filter_calib(t_query, date=date, keep='all',
+                                          flat_min_exptime=0.)[
+                                              'Dataset ID'].tolist(), [date, ]
+    return [], [date, ]
+
+
+cases = [
+    # complete in the evening
+    (calib_rows(55197.8, 5, 10, 12, 'evening'),
+     ['FEROS.evening.{}'.format(ii) for ii in range(27)], []),
+    # two sequences in the evening, the last one is used
+    (calib_rows(55197.6, 5, 10, 12, 'early') +
+     calib_rows(55197.8, 5, 10, 12, 'late'),
+     ['FEROS.late.{}'.format(ii) for ii in range(27)], []),
+    # only in the morning after the night
+    (calib_rows(55198.3, 5, 10, 12, 'morning'),
+     ['FEROS.morning.{}'.format(ii) for ii in range(27)], []),
+    # incomplete, all files of the night are downloaded
+    (calib_rows(55197.8, 3, 10, 12, 'incomplete'),
+     ['FEROS.incomplete.{}'.format(ii) for ii in range(25)], ['2010-01-01']),
+    # nothing in the night
+    (calib_rows(55199.3, 5, 10, 12, 'other'), [], ['2010-01-01']),
+]
+
+
+@pytest.mark.parametrize('rows, down_ids, check_manually', cases)
+def test_select_calib_matches_previous(rows, down_ids, check_manually):
+    t_query = pd.DataFrame(rows)
+    selected = download_sort._select_calib(t_query, night)
+    assert selected == previous_select(t_query)
+    assert isinstance(selected[0], list)
+    assert selected == (down_ids, check_manually)
+
+
+def test_select_calib_robust():
+    t_query = pd.DataFrame(calib_rows(55197.8, 3, 10, 12, 'incomplete'))
+    assert download_sort._select_calib(t_query, night,
+                                       unrobust_calibfiles=False) == \
+        ([], ['2010-01-01'])
+    assert previous_select(t_query, unrobust_calibfiles=False) == \
+        ([], ['2010-01-01'])
@@ -0,0 +1,101 @@
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+import pytest
+
+pytest.importorskip('pandas')
+pytest.importorskip('requests')
+import eso_query
+
+csv_header = 'OBJECT,RA,DEC,Dataset ID,MJD-OBS,Airmass\n'
+
+
+class StubArchive(BaseHTTPRequestHandler):
+    '''Answers with one csv row containing the queried target. The first
+    request for a target named "flaky" fails, a target named "errorpage" gets
+    an html page instead of the csv'''
+    failed = set()
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        target = params['target'][0]
+        if target == 'flaky' and target not in StubArchive.failed:
+            StubArchive.failed.add(target)
+            self.send_response(503)
+            self.end_headers()
+            return
+        if target == 'errorpage':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.end_headers()
+            self.wfile.write(b'<html><body>Service unavailable</body></html>')
+            return
+        body = csv_header + '{},01:00:00,-10:00:00,FEROS.{}.fits,58000.1,1.2\n'.format(
+            target, target)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_url():
+    server = HTTPServer(('127.0.0.1', 0), StubArchive)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}/query'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_csvs_keeps_order(stub_url):
+    params = [eso_query.query_params(target) for target in ['HD_1', 'HD_2',
+                                                           'HD_3']]
+    csvtexts = eso_query.fetch_csvs(params, concurrency=2, url=stub_url)
+    tables = [eso_query.parse_csv(csvtext) for csvtext in csvtexts]
+    assert [table['OBJECT'][0] for table in tables] == ['HD_1', 'HD_2', 'HD_3']
+
+
+def test_fetch_csvs_retries(stub_url):
+    csvtexts = eso_query.fetch_csvs([eso_query.query_params('flaky')],
+                                    url=stub_url, backoff=0.01)
+    assert eso_query.parse_csv(csvtexts[0])['OBJECT'][0] == 'flaky'
+
+
+def test_fetch_csvs_returns_errors():
+    csvtexts = eso_query.fetch_csvs([eso_query.query_params('HD_1')],
+                                    url='http://127.0.0.1:1/query',
+                                    max_retries=0, timeout=2.)
+    assert isinstance(csvtexts[0], Exception)
+
+
+def test_query_eso_with_stub_url(stub_url, tmp_path):
+    pytest.importorskip('astroquery')
+    import download_sort
+    table = download_sort.query_eso('HD_10700', url=stub_url,
+                                    cache_dir=str(tmp_path))
+    assert list(table['Dataset ID']) == ['FEROS.HD_10700.fits']
+    # answered from the cache now
+    nhits = download_sort.query_cache_stats['hit']
+    download_sort.query_eso('HD_10700', url=stub_url, cache_dir=str(tmp_path))
+    assert download_sort.query_cache_stats['hit'] == nhits + 1
+
+
+def test_valid_csv():
+    assert eso_query.valid_csv(csv_header + 'HD_1,01:00:00,-10:00:00,x,1.,1.\n')
+    assert eso_query.valid_csv('# no results\n\n')
+    assert not eso_query.valid_csv('<html><body>Error</body></html>')
+
+
+def test_query_eso_doesnt_cache_errors(stub_url, tmp_path):
+    pytest.importorskip('astroquery')
+    import download_sort
+    for ii in range(2):
+        nmisses = download_sort.query_cache_stats['miss']
+        table = download_sort.query_eso('errorpage', url=stub_url,
+                                        cache_dir=str(tmp_path))
+        assert len(table) == 0
+        assert download_sort.query_cache_stats['miss'] == nmisses + 1
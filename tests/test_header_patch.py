@@ -0,0 +1,66 @@
+import csv
+import warnings
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('astropy')
+from astropy.io import fits
+import header_patch
+
+
+def write_fits(pn):
+    hdu = fits.PrimaryHDU(np.arange(1000, dtype=np.int16))
+    hdu.header['OBJECT'] = 'HD 10700'
+    hdu.header['EXPTIME'] = 300.
+    hdu.writeto(pn, checksum=True)
+
+
+def read_checked(pn):
+    '''the primary header, failing on a wrong CHECKSUM or DATASUM'''
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        with fits.open(pn, checksum=True) as hdul:
+            return hdul[0].header.copy()
+
+
+def test_patch_inplace_and_undo(tmp_path):
+    pn = str(tmp_path / 'FEROS.2019-01-01T01:00:00.000.fits')
+    pnlog = str(tmp_path / 'header_changes.csv')
+    write_fits(pn)
+    with open(pn, 'rb') as ff:
+        data = ff.read()[header_patch.block_length:]
+
+    nchanged = header_patch.patch_headers(
+        {pn: {'OBJECT': 'tau Ceti', 'EXPTIME': 600., 'PATCHED': 1}},
+        pnlog=pnlog)
+    assert nchanged == 3
+    with open(pnlog, 'r', newline='') as flog:
+        rows = list(csv.DictReader(flog))
+    assert [row['method'] for row in rows] == ['inplace', ] * 3
+    with open(pn, 'rb') as ff:
+        assert ff.read()[header_patch.block_length:] == data
+    header = read_checked(pn)
+    assert header['OBJECT'] == 'tau Ceti'
+    assert header['EXPTIME'] == 600.
+    assert header['PATCHED'] == 1
+
+    header_patch.undo_patches(pnlog=pnlog)
+    header = read_checked(pn)
+    assert header['OBJECT'] == 'HD 10700'
+    assert header['EXPTIME'] == 300.
+    assert 'PATCHED' not in header
+
+
+def test_patched_files_are_logged_on_errors(tmp_path):
+    pn = str(tmp_path / 'FEROS.2019-01-01T01:00:00.000.fits')
+    pnlog = str(tmp_path / 'header_changes.csv')
+    write_fits(pn)
+    with pytest.raises(OSError):
+        header_patch.patch_headers({str(tmp_path / 'missing.fits'): {'OBJECT': 'x'},
+                                    pn: {'OBJECT': 'tau Ceti'}},
+                                   pnlog=pnlog, nworkers=1)
+    with open(pnlog, 'r', newline='') as flog:
+        rows = list(csv.DictReader(flog))
+    assert [(row['path'], row['keyword']) for row in rows] == [(pn, 'OBJECT')]
+    header_patch.undo_patches(pnlog=pnlog)
+    assert read_checked(pn)['OBJECT'] == 'HD 10700'
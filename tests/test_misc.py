@@ -0,0 +1,35 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('astropy')
+from astropy.time import Time
+from misc import find_night, find_nights
+
+
+def scalar_night(mjd):
+    '''the night as found by find_night before it was vectorized'''
+    dtime = Time(mjd, format='mjd')
+    if (dtime.mjd % 1) >= 0.5:  # evening
+        return dtime.iso[:10]
+    return Time((dtime.jd - 1), format='jd').iso[:10]
+
+
+# around noon (UTC) of 2019-01-01, midnight and a leap day
+mjds = [58484.4999, 58484.5, 58484.5001, 58484.0, 58484.9999, 58485.0001,
+        58908.25, 58908.75, 58909.49, 51544.5]
+
+
+def test_find_nights_matches_scalar():
+    nights = find_nights(mjds)
+    labels = find_nights(mjds, labels=True)
+    for mjd, night, label in zip(mjds, nights, labels):
+        expected = scalar_night(mjd)
+        assert label == expected.replace('-', '')
+        assert Time(float(night), format='mjd').iso[:10] == expected
+        assert find_night(mjd).iso[:10] == expected
+
+
+def test_find_nights_noon_boundary():
+    assert list(find_nights([58484.4999, 58484.5])) == [58483, 58484]
+    assert list(find_nights(np.array([58484.4999, 58484.5]),
+                            labels=True)) == ['20181231', '20190101']
@@ -0,0 +1,54 @@
+import pytest
+
+pytest.importorskip('pandas')
+pytest.importorskip('astropy')
+from astropy.table import Table
+import stellar_metadata
+
+
+def stub_resolver(names):
+    known = {'HD_10700': {'ra': 26.02, 'dec': -15.94, 'pmra': -1721.,
+                          'pmdec': 854., 'spt': 'G8V'},
+             'GJ_581': {'ra': 229.86, 'dec': -7.72, 'pmra': -1222.,
+                        'pmdec': -98., 'spt': 'M3V'}}
+    stub_resolver.calls.append(list(names))
+    return dict([(name, known[name]) for name in names if name in known])
+
+
+def test_get_stellar_metadata_offline(tmp_path):
+    stub_resolver.calls = []
+    pncache = str(tmp_path / 'stellar_metadata.csv')
+    metadata = stellar_metadata.get_stellar_metadata(
+        ['HD_10700', 'GJ_581', 'unknown'], pncache=pncache,
+        resolver=stub_resolver)
+    assert stub_resolver.calls == [['HD_10700', 'GJ_581', 'unknown']]
+    assert sorted(metadata.keys()) == ['GJ_581', 'HD_10700']
+    assert metadata['HD_10700']['mask'] == 'G2'
+    assert metadata['GJ_581']['mask'] == 'M2'
+
+    # the second call is answered from the cache
+    metadata = stellar_metadata.get_stellar_metadata(
+        ['HD_10700'], pncache=pncache, resolver=stub_resolver)
+    assert len(stub_resolver.calls) == 1
+    assert metadata['HD_10700']['pmra'] == -1721.
+
+
+def test_mask_from_spt():
+    assert stellar_metadata.mask_from_spt('K2III') == 'K5'
+    assert stellar_metadata.mask_from_spt('M0.5V') == 'M2'
+    assert stellar_metadata.mask_from_spt(None) == 'G2'
+
+
+def test_match_rows_with_unresolved_object():
+    # Simbad left out the second object
+    result = Table({'MAIN_ID': ['* tau Cet', 'HD 25457'],
+                    'SCRIPT_NUMBER_ID': [1, 3]})
+    matched = stellar_metadata._match_rows(result, ['HD_10700', 'nonsense',
+                                                    'HD_25457'])
+    assert [(name, str(row['MAIN_ID'])) for name, row in matched] == [
+        ('HD_10700', '* tau Cet'), ('HD_25457', 'HD 25457')]
+
+    result = Table({'main_id': ['HD 25457'],
+                    'user_specified_id': ['HD 25457']})
+    matched = stellar_metadata._match_rows(result, ['nonsense', 'HD_25457'])
+    assert [name for name, row in matched] == ['HD_25457']
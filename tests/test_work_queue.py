@@ -0,0 +1,76 @@
+import time
+import work_queue
+
+
+def make_nights(tmp_path, nfiles):
+    '''night folders with nfiles[ii] fits files and the science_files.csv'''
+    lines = []
+    for inight, nfits in enumerate(nfiles):
+        night_dir = tmp_path / 'HD_10700' / 'night{}'.format(inight)
+        night_dir.mkdir(parents=True)
+        for ifile in range(nfits):
+            pn = night_dir / 'FEROS.{}.fits'.format(ifile)
+            pn.write_bytes(b'\0' * 2880)
+            lines.append('HD_10700, {}\n'.format(pn))
+    (tmp_path / 'science_files.csv').write_text(''.join(lines))
+    return [str(tmp_path / 'HD_10700' / 'night{}'.format(inight))
+            for inight in range(len(nfiles))]
+
+
+def test_fill_and_claim(tmp_path):
+    pnqueue = str(tmp_path / 'work_queue.sqlite')
+    night_dirs = make_nights(tmp_path, [16, 20, 3])
+    assert work_queue.fill_queue(pnqueue, log_dir=str(tmp_path)) == 2
+    # filling again keeps the units
+    assert work_queue.fill_queue(pnqueue, log_dir=str(tmp_path)) == 0
+
+    # the heaviest unit comes first and no unit is handed out twice
+    assert work_queue.claim_unit(pnqueue, 'a') == ('HD_10700', night_dirs[1])
+    assert work_queue.claim_unit(pnqueue, 'b') == ('HD_10700', night_dirs[0])
+    assert work_queue.claim_unit(pnqueue, 'c') is None
+    work_queue.finish_unit(pnqueue, night_dirs[1], 'a', 0)
+    work_queue.finish_unit(pnqueue, night_dirs[0], 'b', 0)
+    assert work_queue.queue_status(pnqueue) == {'done': (2, 36)}
+
+    # a changed folder is handed out again
+    (tmp_path / 'HD_10700' / 'night0' / 'FEROS.new.fits').write_bytes(b'\0' * 2880)
+    work_queue.fill_queue(pnqueue, log_dir=str(tmp_path))
+    assert work_queue.claim_unit(pnqueue, 'a') == ('HD_10700', night_dirs[0])
+    assert work_queue.claim_unit(pnqueue, 'b') is None
+
+
+def test_max_attempts(tmp_path):
+    pnqueue = str(tmp_path / 'work_queue.sqlite')
+    night_dirs = make_nights(tmp_path, [16])
+    work_queue.fill_queue(pnqueue, log_dir=str(tmp_path))
+    calls = []
+
+    def reduce_unit(target, night_dir):
+        calls.append(night_dir)
+        raise RuntimeError('ceres crashed')
+
+    assert work_queue.run_worker(reduce_unit, pnqueue, worker='a',
+                                 max_attempts=2) == 2
+    assert calls == night_dirs * 2
+    assert list(work_queue.queue_status(pnqueue).keys()) == ['failed']
+
+
+def test_stale_claims(tmp_path):
+    pnqueue = str(tmp_path / 'work_queue.sqlite')
+    night_dirs = make_nights(tmp_path, [16])
+    work_queue.fill_queue(pnqueue, log_dir=str(tmp_path))
+    # the node of a dies without finishing its unit
+    assert work_queue.claim_unit(pnqueue, 'a', max_attempts=2) is not None
+    assert work_queue.claim_unit(pnqueue, 'b', stale_after=60.,
+                                 max_attempts=2) is None
+    time.sleep(0.1)
+    assert work_queue.claim_unit(pnqueue, 'b', stale_after=0.05,
+                                 max_attempts=2) == ('HD_10700', night_dirs[0])
+    # a can no longer finish the unit of b
+    work_queue.finish_unit(pnqueue, night_dirs[0], 'a', 0)
+    assert list(work_queue.queue_status(pnqueue).keys()) == ['claimed']
+    # b dies as well, which uses up the attempts
+    time.sleep(0.1)
+    assert work_queue.claim_unit(pnqueue, 'c', stale_after=0.05,
+                                 max_attempts=2) is None
+    assert list(work_queue.queue_status(pnqueue).keys()) == ['failed']
@@ -0,0 +1,208 @@
+import os
+import json
+import hashlib
+import socket
+import sqlite3
+import threading
+import time
+from config import default_log_dir
+
+
+def fill_queue(pnqueue=None, targets=None, log_dir=None, min_files=16,
+               reset=False):
+    '''Add the (target, night folder) units of the science files in the download
+    log (science_files.csv in the log_dir) to the queue. Each unit is weighted by
+    the number of fits files in its folder; the heaviest units are handed out
+    first. Units which are in the queue already are kept, so every node can
+    call this. Finished units whose folder changed since (e.g. new downloads)
+    are handed out again. Returns the number of units added.
+    pnqueue=None
+    path of the queue on storage shared by all nodes. Uses work_queue.sqlite in
+    the default_log_dir if None
+    targets=None
+    only add the units of these targets
+    min_files=16
+    folders with less fits files are ignored, as in all_subfolders
+    reset=False
+    set to True to hand out all units again (e.g. after new downloads). Units
+    which did not change are then skipped quickly by the reduction'''
+    if log_dir is None:
+        log_dir = default_log_dir
+    units = {}
+    with open(os.path.join(log_dir, 'science_files.csv'), 'r') as flog:
+        for line in flog:
+            entries = [entry.strip() for entry in line.split(',')]
+            if len(entries) < 2 or entries[1] == '':
+                continue
+            if targets is not None and entries[0] not in targets:
+                continue
+            units.setdefault(os.path.dirname(os.path.abspath(entries[1])),
+                             entries[0])
+    rows = []
+    for night_dir, target in units.items():
+        if not os.path.isdir(night_dir):
+            continue
+        nfits = len([ff for ff in os.listdir(night_dir) if ff.endswith('.fits')])
+        if nfits < min_files:
+            print('Not queueing {} as it has less than {} fits files'.format(
+                night_dir, min_files))
+            continue
+        rows.append((night_dir, target, nfits, _folder_fingerprint(night_dir)))
+    con = _connect(pnqueue)
+    try:
+        with con:
+            nbefore = con.execute('SELECT COUNT(*) FROM units').fetchone()[0]
+            con.executemany("INSERT OR IGNORE INTO units (night_dir, target, \
+weight, fingerprint, state, attempts) VALUES (?, ?, ?, ?, 'todo', 0)", rows)
+            # the number of files may have changed
+            con.executemany('UPDATE units SET weight=? WHERE night_dir=?',
+                            [(nfits, night_dir) for night_dir, target, nfits,
+                             fingerprint in rows])
+            nchanged = sum([con.execute("UPDATE units SET state='todo', \
+attempts=0, worker=NULL WHERE night_dir=? AND state IN ('done', 'failed') AND \
+(fingerprint IS NULL OR fingerprint!=?)", (night_dir, fingerprint)).rowcount
+                            for night_dir, target, nfits, fingerprint in rows])
+            if reset:
+                con.execute("UPDATE units SET state='todo', attempts=0, \
+worker=NULL WHERE state!='claimed'")
+            nadded = con.execute('SELECT COUNT(*) FROM units').fetchone()[0] - \
+                nbefore
+    finally:
+        con.close()
+    print('Added {} of {} units to the queue, {} changed ones again'.format(
+        nadded, len(rows), nchanged))
+    return nadded
+
+
+def run_worker(reduce_unit, pnqueue=None, worker=None, stale_after=900.,
+               heartbeat_interval=60., max_attempts=2):
+    '''Claim units from the queue and process them until none is left.
+    reduce_unit(target, night_dir) is called for each unit and should return
+    0 on success. While it runs, a heartbeat is written every heartbeat_interval
+    seconds. Claims without a heartbeat for stale_after seconds (e.g. of a
+    crashed node) are released and count as failed. Units for which
+    reduce_unit raises count as failed as well. Failed units are tried up to
+    max_attempts times. Returns the number of units processed.
+    worker=None
+    name of the worker in the queue. Uses host and process id if None'''
+    if worker is None:
+        worker = '{}-{}-{}'.format(socket.gethostname(), os.getpid(),
+                                   threading.get_ident())
+    nunits = 0
+    while True:
+        unit = claim_unit(pnqueue, worker, stale_after=stale_after,
+                          max_attempts=max_attempts)
+        if unit is None:
+            break
+        target, night_dir = unit
+        print('{} reducing {} of {}'.format(worker, night_dir, target))
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat, args=(
+            pnqueue, night_dir, worker, heartbeat_interval, stop))
+        heartbeat.start()
+        try:
+            returncode = reduce_unit(target, night_dir)
+        except Exception as error:
+            print('{} failed to reduce {} ({!r})'.format(worker, night_dir,
+                                                        error))
+            returncode = -1
+        finally:
+            stop.set()
+            heartbeat.join()
+        finish_unit(pnqueue, night_dir, worker, returncode)
+        nunits += 1
+    print('{} found no more units in the queue after {}'.format(worker, nunits))
+    return nunits
+
+
+def claim_unit(pnqueue, worker, stale_after=900., max_attempts=2):
+    '''Release stale claims and claim the heaviest open unit. Returns
+    (target, night_dir) or None if there is nothing left'''
+    con = _connect(pnqueue)
+    try:
+        # BEGIN IMMEDIATE takes the write lock, so no two workers get the same unit
+        con.execute('BEGIN IMMEDIATE')
+        now = time.time()
+        # stale claims count as failed attempts, so a unit which keeps killing
+        # its node is not handed out forever
+        nstale = con.execute("UPDATE units SET state='failed', worker=NULL WHERE \
+state='claimed' AND heartbeat<?", (now - stale_after,)).rowcount
+        if nstale > 0:
+            print('Released {} stale claims'.format(nstale))
+        row = con.execute("SELECT target, night_dir FROM units WHERE state='todo' \
+OR (state='failed' AND attempts<?) ORDER BY weight DESC LIMIT 1",
+                          (max_attempts,)).fetchone()
+        if row is not None:
+            con.execute("UPDATE units SET state='claimed', worker=?, claimed=?, \
+heartbeat=?, attempts=attempts+1 WHERE night_dir=?", (worker, now, now, row[1]))
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        con.close()
+    if row is None:
+        return None
+    return tuple(row)
+
+
+def finish_unit(pnqueue, night_dir, worker, returncode):
+    '''Mark the unit as done (returncode 0) or failed, if it is still claimed by
+    worker. The fingerprint of the folder after the reduction is stored, to
+    find out later whether it changed'''
+    fingerprint = _folder_fingerprint(night_dir)
+    con = _connect(pnqueue)
+    try:
+        with con:
+            con.execute("UPDATE units SET state=?, returncode=?, finished=?, \
+fingerprint=? WHERE night_dir=? AND worker=? AND state='claimed'", (
+                'done' if returncode == 0 else 'failed', returncode, time.time(),
+                fingerprint, night_dir, worker))
+    finally:
+        con.close()
+
+
+def queue_status(pnqueue=None):
+    '''Print and return the number of units and fits files in each state'''
+    con = _connect(pnqueue)
+    try:
+        status = dict([(row[0], row[1:]) for row in con.execute(
+            'SELECT state, COUNT(*), SUM(weight) FROM units GROUP BY state')])
+    finally:
+        con.close()
+    for state, (nunits, nfits) in status.items():
+        print('{}: {} units ({} fits files)'.format(state, nunits, nfits))
+    return status
+
+
+def _folder_fingerprint(night_dir):
+    '''Hash of the names, sizes and modification times of the fits files in
+    night_dir'''
+    fitsfiles = sorted([(ff.name, ff.stat().st_size, ff.stat().st_mtime)
+                        for ff in os.scandir(night_dir) if ff.name.endswith('.fits')
+                        and ff.is_file()])
+    return hashlib.sha1(json.dumps(fitsfiles).encode('utf-8')).hexdigest()
+
+
+def _heartbeat(pnqueue, night_dir, worker, interval, stop):
+    while not stop.wait(interval):
+        con = _connect(pnqueue)
+        try:
+            with con:
+                con.execute('UPDATE units SET heartbeat=? WHERE night_dir=? AND \
+worker=?', (time.time(), night_dir, worker))
+        except sqlite3.OperationalError as error:
+            print('Couldnt write the heartbeat of {} ({})'.format(night_dir, error))
+        finally:
+            con.close()
+
+
+def _connect(pnqueue=None):
+    if pnqueue is None:
+        pnqueue = os.path.join(default_log_dir, 'work_queue.sqlite')
+    # no WAL, as it doesnt work on network file systems
+    con = sqlite3.connect(pnqueue, timeout=120)
+    con.execute('CREATE TABLE IF NOT EXISTS units (night_dir TEXT PRIMARY KEY, \
+target TEXT, weight INTEGER, fingerprint TEXT, state TEXT, worker TEXT, attempts INTEGER, \
+claimed REAL, heartbeat REAL, finished REAL, returncode INTEGER)')
+    return con